@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""
+Pack sprites into a few large sheets and write the NML for them.
+
+The sprites are read from an offset table, a CSV file with the image file and
+its NML x and y offsets on every row. Rows starting with # are skipped. The
+sprites are placed on shelves, tallest first, and a new sheet is started
+when one is full. Sprites with the same pixels are stored only once. The
+result is one NML real sprite per table row, in the same order:
+
+[x, y, w, h, xoff, yoff, "sheet.png"]
+
+All the sprites must have the same mode, and 8bpp sprites the same palette.
+"""
+
+import argparse
+import csv
+import hashlib
+import sys
+
+from PIL import Image
+
+import instrument
+import pngsave
+
+# Largest width and height of a sheet
+SHEET_SIZE = 2048
+
+def read_table(path):
+    """Read an offset table as a list of (file, xoff, yoff) tuples"""
+    sprites = []
+    with open(path) as f:
+        for row in csv.reader(f):
+            row = [i.strip() for i in row]
+            if not row or not row[0] or row[0].startswith('#'):
+                continue
+            sprites.append((row[0], int(row[1]), int(row[2])))
+    return sprites
+
+def write_table(path, sprites):
+    """Write (file, xoff, yoff) tuples as an offset table"""
+    with open(path, 'w') as f:
+        writer = csv.writer(f, lineterminator='\n')
+        for row in sprites:
+            writer.writerow(row)
+
+def pack(sizes, sheet_size=SHEET_SIZE, padding=0):
+    """
+    Place rectangles on shelves. Return the (sheet, x, y) of every size, in
+    the same order, and the used (width, height) of every sheet.
+    """
+    for w, h in sizes:
+        if w > sheet_size or h > sheet_size:
+            raise ValueError('Sprite of {0}x{1} does not fit a sheet'.format(
+                    w, h))
+    order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1],
+            -sizes[i][0]))
+    places = [None] * len(sizes)
+    sheets = []
+    sheet = -1
+    # Position of the current shelf and how far it is filled
+    x = y = shelf_height = sheet_size
+    for i in order:
+        w, h = sizes[i]
+        if x + w > sheet_size:
+            # Next shelf
+            x = 0
+            y += shelf_height + padding
+            shelf_height = h
+        if y + h > sheet_size:
+            # Next sheet
+            sheet += 1
+            sheets.append((0, 0))
+            x = y = 0
+            shelf_height = h
+        places[i] = (sheet, x, y)
+        used = sheets[sheet]
+        sheets[sheet] = (max(used[0], x + w), max(used[1], y + h))
+        x += w + padding
+    return places, sheets
+
+@instrument.timed('atlas.build')
+def build(sprites, basename, sheet_size=SHEET_SIZE, padding=0,
+        profile='default'):
+    """
+    Pack (image, xoff, yoff) sprites into sheets named basename_0.png and so
+    on. Return (x, y, w, h, xoff, yoff, sheet name) for every sprite.
+    """
+    imgs = [i[0] for i in sprites]
+    modes = set(i.mode for i in imgs)
+    if len(modes) > 1:
+        raise ValueError('Sprites have different modes: {0}'.format(
+                ', '.join(sorted(modes))))
+    mode = modes.pop()
+    palette = None
+    if mode == 'P':
+        palettes = set(tuple(i.getpalette()[:768]) for i in imgs)
+        if len(palettes) > 1:
+            raise ValueError('Sprites have different palettes')
+        palette = list(palettes.pop())
+
+    # Sprites with the same pixels share their place on the sheet
+    unique = {}
+    keys = []
+    for img in imgs:
+        key = (img.size, hashlib.md5(img.tobytes()).digest())
+        unique.setdefault(key, img)
+        keys.append(key)
+    instrument.count('duplicates', len(imgs) - len(unique))
+    unique_keys = list(unique)
+    places, sizes = pack([unique[i].size for i in unique_keys], sheet_size,
+            padding)
+    place_of = dict(zip(unique_keys, places))
+
+    names = ['{0}_{1}.png'.format(basename, i) for i in range(len(sizes))]
+    for sheet, size in enumerate(sizes):
+        # Transparent for 32bpp, index 0 is transparent in ttd palettes
+        img_out = Image.new(mode, size, 0)
+        if palette is not None:
+            img_out.putpalette(palette)
+        for key in unique_keys:
+            if place_of[key][0] == sheet:
+                img_out.paste(unique[key], place_of[key][1:])
+        pngsave.save(img_out, names[sheet], profile)
+
+    entries = []
+    for (img, xoff, yoff), key in zip(sprites, keys):
+        sheet, x, y = place_of[key]
+        entries.append((x, y, img.size[0], img.size[1], xoff, yoff,
+                names[sheet]))
+    return entries
+
+def nml_lines(entries):
+    """NML real sprites of build entries"""
+    return ['[{0}, {1}, {2}, {3}, {4}, {5}, "{6}"]'.format(*i)
+            for i in entries]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Pack the sprites of an offset table into sheets.')
+    parser.add_argument('table', help='Offset table of the sprites.')
+    parser.add_argument('basename', help=
+            'Sheets are saved as basename_0.png, basename_1.png and so on.')
+    parser.add_argument('-n', '--nml', help=
+            'File for the NML sprites, printed if not given.')
+    parser.add_argument('-s', '--sheet-size', type=int, default=SHEET_SIZE,
+            help='Largest width and height of a sheet. Default {0}.'.format(
+            SHEET_SIZE))
+    parser.add_argument('-p', '--padding', type=int, default=0, help=
+            'Empty pixels between sprites. Default 0.')
+    parser.add_argument('-P', '--png', choices=sorted(pngsave.PROFILES),
+            default='default', help='PNG profile of the sheets.')
+    args = parser.parse_args(argv)
+
+    sprites = []
+    for name, xoff, yoff in read_table(args.table):
+        img = Image.open(name)
+        img.load()
+        sprites.append((img, xoff, yoff))
+    entries = build(sprites, args.basename, args.sheet_size, args.padding,
+            args.png)
+    lines = '\n'.join('\t' + i for i in nml_lines(entries)) + '\n'
+    if args.nml:
+        with open(args.nml, 'w') as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
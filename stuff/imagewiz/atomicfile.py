@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+Writing files so that other processes never read them half written.
+
+The data is written to a temporary file next to the target, which is then
+renamed over it. Readers see either the old file or the complete new one.
+"""
+
+import os
+
+def atomic_write(path, write, mode='wb'):
+    """Call write with an open temporary file, then rename it to path"""
+    temp = '{0}.{1}.tmp'.format(path, os.getpid())
+    try:
+        with open(temp, mode) as f:
+            write(f)
+        os.rename(temp, path)
+    except:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+def write_cache(path, write, mode='wb'):
+    """
+    atomic_write for cache files, creating the directory if needed. Not
+    being able to cache something is not fatal, so errors are ignored.
+    Return True if the file was written.
+    """
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        atomic_write(path, write, mode)
+    except (IOError, OSError):
+        return False
+    return True
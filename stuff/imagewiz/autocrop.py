@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""
+Autocrop a set of frames and write their NML offsets.
+
+The bounding boxes of all the frames are found together, and the frames
+are cropped in place or into an output directory. Every frame gets the base
+offsets plus the top left corner of its bounding box. The offsets are
+written as an offset table, which atlas.py reads, and as NML real sprites:
+
+[xoff, yoff, "file"]
+"""
+
+import argparse
+import os
+import sys
+
+import atlas
+import instrument
+from wiz import ImageWiz, autocrop_batch
+import pngsave
+
+def crop_frames(names, outdir=None, xoff=0, yoff=0, profile='default'):
+    """
+    Crop frames and save them, return (file, xoff, yoff) for every saved
+    frame.
+    """
+    imgs = [ImageWiz(i) for i in names]
+    offsets = autocrop_batch(imgs)
+    sprites = []
+    for name, img, (left, top) in zip(names, imgs, offsets):
+        if outdir is not None:
+            name = os.path.join(outdir, os.path.basename(name))
+        img.save(name, profile)
+        sprites.append((name, xoff + left, yoff + top))
+    return sprites
+
+def nml_lines(sprites):
+    """NML real sprites of (file, xoff, yoff) tuples"""
+    return ['[{1}, {2}, "{0}"]'.format(*i) for i in sprites]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Autocrop frames and write their NML offsets.')
+    parser.add_argument('frames', nargs='+', help='Image files to crop.')
+    parser.add_argument('-o', '--outdir', help=
+            'Save the cropped frames here instead of over the originals.')
+    parser.add_argument('-x', '--xoff', type=int, default=0, help=
+            'X offset of the uncropped frames. Default 0.')
+    parser.add_argument('-y', '--yoff', type=int, default=0, help=
+            'Y offset of the uncropped frames. Default 0.')
+    parser.add_argument('-t', '--table', help='File for the offset table.')
+    parser.add_argument('-n', '--nml', help=
+            'File for the NML sprites, printed if not given.')
+    parser.add_argument('-P', '--png', choices=sorted(pngsave.PROFILES),
+            default='default', help='PNG profile of the cropped frames.')
+    parser.add_argument('--stats', choices=instrument.MODES, help=
+            'Record the time and pixels of every operation.')
+    args = parser.parse_args(argv)
+    if args.stats:
+        instrument.enable(args.stats, os.environ.get('IMAGEWIZ_STATS_FILE'))
+
+    sprites = crop_frames(args.frames, args.outdir, args.xoff, args.yoff,
+            args.png)
+    if args.table:
+        atlas.write_table(args.table, sprites)
+    lines = '\n'.join('\t' + i for i in nml_lines(sprites)) + '\n'
+    if args.nml:
+        with open(args.nml, 'w') as f:
+            f.write(lines)
+    else:
+        sys.stdout.write(lines)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
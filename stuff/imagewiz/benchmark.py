@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+"""
+Stage level benchmarks for tiq and ImageWiz.
+
+Every stage is timed over the checked in test images and a few large
+synthetic images, and the throughput is reported in pixels per second. The
+results are compared against a stored baseline, and the run fails if any
+stage has become slower than the baseline allows, or if there is no
+baseline to compare against. Baselines depend on the machine, so they are
+not checked in. Save one with --save-baseline before making changes.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from wiz import ImageWiz
+from palette import palettes
+import tiq
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+BENCH_PATH = os.path.dirname(os.path.abspath(__file__))
+BASELINE = os.path.join(BENCH_PATH, 'benchmark_baseline.json')
+
+INPUTS = ('tester.png', 'gr_2x.png', 'corner_big_4x.png')
+# Side length of the synthetic images
+SYNTHETIC_SIZE = 1024
+# The slow quantizers are skipped for images with more unique colors
+SLOW_QUANT_COLORS = 20000
+# Stages faster than this are run several times per sample, up to MAX_LOOPS
+# times, since shorter samples can't be timed reliably
+MIN_SAMPLE = 0.01
+MAX_LOOPS = 1000
+
+def load_inputs(synthetic=True):
+    """Images to run the benchmarks on, keyed by name"""
+    inputs = {}
+    for name in INPUTS:
+        img = Image.open(os.path.join(BENCH_PATH, name))
+        inputs[name] = img.convert('RGBA')
+    if synthetic:
+        size = (SYNTHETIC_SIZE, SYNTHETIC_SIZE)
+        # Smooth render-like image with lots of unique colors
+        inputs['synthetic_smooth'] = inputs['tester.png'].resize(size,
+                Image.BICUBIC)
+        # Worst case for everything that depends on unique colors. Seeded,
+        # so that every run times the same image.
+        if np is not None:
+            noise = np.random.RandomState(0).randint(0, 256,
+                    (size[1], size[0], 4)).astype(np.uint8)
+            inputs['synthetic_noise'] = Image.fromarray(noise, 'RGBA')
+    return inputs
+
+def best_time(setup, run, repeat):
+    """
+    Best time of several runs, setup is not included in the timing. Fast
+    stages are run several times in each sample, see MIN_SAMPLE.
+    """
+    def sample(loops):
+        args = [setup() for i in range(loops)]
+        start = time.time()
+        for arg in args:
+            run(arg)
+        return (time.time() - start) / loops
+    first = sample(1)
+    loops = 1
+    if first < MIN_SAMPLE:
+        loops = min(MAX_LOOPS, int(MIN_SAMPLE / max(first, 1e-6)) + 1)
+    # With several loops the first run only measured how many are needed
+    times = [first] if loops == 1 else []
+    while len(times) < repeat:
+        times.append(sample(loops))
+    return min(times)
+
+def tiq_stages(name, img, palette):
+    """Benchmarks of the tiq stages, as (stage, setup, run) tuples"""
+    rgb = tiq.convert(img.copy(), palette.bg)
+    colors = tiq.get_unique_colors(rgb)
+    mapping = tiq.quant_kdtree(colors, palette.neutral)
+    indices = tiq.indexify(dict(mapping), palette.full)
+    # Build the lookup table outside the timing
+    lut = tiq.get_lut(palette, None)
+
+    stages = [
+        ('tiq.convert', img.copy,
+            lambda x: tiq.convert(x, palette.bg)),
+        ('tiq.get_unique_colors', lambda: rgb, tiq.get_unique_colors),
+        ('tiq.quant_lut', lambda: rgb, lut.apply),
+        ('tiq.quant_kdtree', lambda: colors,
+            lambda x: tiq.quant_kdtree(x, palette.neutral)),
+        ('tiq.indexify', lambda: dict(mapping),
+            lambda x: tiq.indexify(x, palette.full)),
+        ('tiq.replace_colors', lambda: rgb,
+            lambda x: tiq.replace_colors(x, palette.raw, indices)),
+    ]
+    if len(colors) <= SLOW_QUANT_COLORS:
+        stages.extend([
+            ('tiq.quant_sp', lambda: colors,
+                lambda x: tiq.quant_sp(x, palette.neutral)),
+            ('tiq.quant_brute', lambda: colors,
+                lambda x: tiq.quant_brute(x, palette.neutral)),
+        ])
+    return stages
+
+def imagewiz_stages(name, img, tempdir):
+    """Benchmarks of the ImageWiz operations, as (stage, setup, run) tuples"""
+    infile = os.path.join(tempdir, '{0}_in.png'.format(name))
+    overlay = os.path.join(tempdir, '{0}_overlay.png'.format(name))
+    outfile = os.path.join(tempdir, '{0}_out.png'.format(name))
+    img.save(infile)
+    img.transpose(Image.ROTATE_180).save(overlay)
+
+    def setup():
+        wiz = ImageWiz(infile)
+        wiz.img.load()
+        return wiz
+
+    def reduce_alpha(wiz):
+        # The reduction is deferred until the image is needed
+        wiz.reduce_alpha(128)
+        return wiz.img
+
+    return [
+        ('imagewiz.composite_over', setup,
+            lambda x: x.composite(overlay, 'over')),
+        ('imagewiz.composite_in', setup,
+            lambda x: x.composite(overlay, 'in')),
+        ('imagewiz.composite_multiply', setup,
+            lambda x: x.composite(overlay, 'multiply')),
+        ('imagewiz.composite_layers', setup,
+            lambda x: x.composite_layers([(overlay, 'over'), (overlay, 'in'),
+                                          (overlay, 'out')])),
+        ('imagewiz.resize', setup, lambda x: x.resize('0.5')),
+        ('imagewiz.reduce_alpha', setup, reduce_alpha),
+        ('imagewiz.autocrop', setup, lambda x: x.autocrop()),
+        ('imagewiz.save', setup, lambda x: x.save(outfile)),
+        ('imagewiz.save_fast', setup, lambda x: x.save(outfile, 'fast')),
+        ('imagewiz.save_max', setup, lambda x: x.save(outfile, 'max')),
+    ]
+
+def run_benchmarks(inputs, repeat, stage_filter=None):
+    """Time every stage for every input, return the results keyed by name"""
+    palette = palettes['dos']
+    tempdir = tempfile.mkdtemp(prefix='imagewiz_bench')
+    results = {}
+    # The lookup table is the same for every run, so it is read from the real
+    # cache. The colors found for the benchmark images are not, they go to
+    # color caches in tempdir which are dropped afterwards.
+    tiq.get_lut(palette, None)
+    cache_path = tiq.CACHE_PATH
+    tiq.CACHE_PATH = tempdir
+    try:
+        for name in sorted(inputs):
+            img = inputs[name]
+            pixels = img.size[0] * img.size[1]
+            stages = (tiq_stages(name, img, palette) +
+                      imagewiz_stages(name, img, tempdir))
+            for stage, setup, run in stages:
+                if stage_filter and stage_filter not in stage:
+                    continue
+                seconds = best_time(setup, run, repeat)
+                results['{0}:{1}'.format(stage, name)] = {
+                        'stage': stage,
+                        'input': name,
+                        'pixels': pixels,
+                        'seconds': seconds,
+                        'pixels_per_second': pixels / max(seconds, 1e-9)}
+    finally:
+        tiq.CACHE_PATH = cache_path
+        tiq._color_caches.clear()
+        shutil.rmtree(tempdir)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Print the results next to the baseline. Return the keys of the stages
+    which are slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    print('{0:<26} {1:<18} {2:>9} {3:>10} {4:>10} {5:>8}'.format(
+            'stage', 'input', 'pixels', 'ms', 'Mpx/s', 'ratio'))
+    for key in sorted(results):
+        result = results[key]
+        speed = result['pixels_per_second']
+        ratio = ''
+        if key in baseline:
+            relative = speed / baseline[key]['pixels_per_second']
+            ratio = '{0:.2f}'.format(relative)
+            if relative < 1 - tolerance:
+                regressions.append(key)
+                ratio += ' !!'
+        print('{0:<26} {1:<18} {2:>9} {3:>10.2f} {4:>10.2f} {5:>8}'.format(
+                result['stage'], result['input'], result['pixels'],
+                result['seconds'] * 1000, speed / 1e6, ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Benchmark the tiq and ImageWiz stages against a baseline.')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help=
+            'Runs per stage, the best time is used. Default 5.')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.25, help=
+            'Allowed slowdown compared to the baseline. Default 0.25.')
+    parser.add_argument('-b', '--baseline', default=BASELINE, help=
+            'Baseline file. Default {0}.'.format(BASELINE))
+    parser.add_argument('-s', '--save-baseline', action='store_true', help=
+            'Store the results as the new baseline.')
+    parser.add_argument('-f', '--filter', help=
+            'Only run stages whose name contains this string.')
+    parser.add_argument('--no-synthetic', action='store_true', help=
+            'Skip the large synthetic images.')
+    args = parser.parse_args(argv)
+
+    inputs = load_inputs(not args.no_synthetic)
+    results = run_benchmarks(inputs, args.repeat, args.filter)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Baseline saved to {0}'.format(args.baseline))
+    elif not baseline:
+        print('No baseline found in {0}, save one with --save-baseline'
+              .format(args.baseline))
+        return 1
+    elif regressions:
+        print('')
+        for key in regressions:
+            print('REGRESSION: {0} is slower than the baseline'.format(key))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+"""
+Compositing of a stack of RGBA layers.
+
+The layers are applied to the base image in order, each with its own mode:
+
+over: the layer is pasted over the result
+in: the result is kept where the layer is opaque
+out: the result is kept where the layer is transparent
+multiply: the colors are multiplied where both are opaque, and the layer is
+pasted over the result elsewhere
+
+Over is done by PIL, which is faster than anything done with numpy. In and
+out only change the alpha, so the alpha bands of consecutive in and out
+layers are multiplied together and the image is changed only once for all
+of them. Multiply is done with numpy with premultiplied alpha, a strip of
+rows at a time, and is not available without numpy.
+"""
+
+from PIL import Image, ImageChops
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import instrument
+
+MODES = ('over', 'in', 'out', 'multiply')
+# Pixels multiplied at a time
+STRIP_PIXELS = 1 << 16
+
+def premultiply(pixels):
+    """Float RGBA with premultiplied colors from an array of RGBA bytes"""
+    pixels = pixels.astype(np.float32)
+    pixels *= np.float32(1 / 255.0)
+    pixels[..., :3] *= pixels[..., 3:]
+    return pixels
+
+def unpremultiply(pixels, out):
+    """Write premultiplied float RGBA into an array of RGBA bytes"""
+    alpha = pixels[..., 3:]
+    # Transparent pixels end up black
+    scale = np.zeros(alpha.shape, dtype=np.float32)
+    np.divide(255, alpha, out=scale, where=alpha > 0)
+    pixels[..., :3] *= scale
+    pixels[..., 3:] *= 255
+    pixels += 0.5
+    np.minimum(pixels, 255, out=pixels)
+    out[...] = pixels
+
+def blend_multiply(result, layer):
+    """Multiply a premultiplied layer with the premultiplied result"""
+    # Over, plus the product of the colors in place of the layer color where
+    # the result is opaque
+    product = layer[..., :3] * (result[..., :3] - result[..., 3:])
+    result *= 1 - layer[..., 3:]
+    result += layer
+    result[..., :3] += product
+    return result
+
+def check_layers(img, layers):
+    """Check the modes and sizes of the layers, return them as RGBA"""
+    checked = []
+    for layer, mode in layers:
+        if mode not in MODES:
+            raise ValueError('Unknown mode: {0}'.format(mode))
+        if layer.size != img.size:
+            raise ValueError('Layer of {0}x{1} does not match {2}x{3}'.format(
+                    layer.size[0], layer.size[1], img.size[0], img.size[1]))
+        if layer.mode != 'RGBA':
+            layer = layer.convert('RGBA')
+        checked.append((layer, mode))
+    return checked
+
+@instrument.timed('compositor.composite')
+def composite(img, layers):
+    """
+    Apply a list of (image, mode) layers to an image, return the result as a
+    new RGBA image.
+    """
+    original = img
+    if img.mode != 'RGBA':
+        img = img.convert('RGBA')
+    layers = check_layers(img, layers)
+    i = 0
+    while i < len(layers):
+        layer, mode = layers[i]
+        if mode == 'over':
+            img = Image.alpha_composite(img, layer)
+            i += 1
+        elif mode == 'multiply':
+            img = multiply(img, layer)
+            i += 1
+        else:
+            alpha = img.getchannel('A')
+            while i < len(layers) and layers[i][1] in ('in', 'out'):
+                mask = layers[i][0].getchannel('A')
+                if layers[i][1] == 'out':
+                    mask = ImageChops.invert(mask)
+                alpha = ImageChops.multiply(alpha, mask)
+                i += 1
+            if img is original:
+                img = img.copy()
+            img.putalpha(alpha)
+    if img is original:
+        img = img.copy()
+    return img
+
+def multiply(img, layer):
+    """Multiply blend a layer over an image"""
+    if np is None:
+        raise ValueError('Mode multiply needs numpy')
+    base = np.asarray(img)
+    pixels = np.asarray(layer)
+    out = np.empty(base.shape, dtype=np.uint8)
+    step = max(1, STRIP_PIXELS // img.size[0])
+    for top in range(0, base.shape[0], step):
+        rows = slice(top, top + step)
+        result = blend_multiply(premultiply(base[rows]),
+                premultiply(pixels[rows]))
+        unpremultiply(result, out[rows])
+    return Image.fromarray(out, 'RGBA')
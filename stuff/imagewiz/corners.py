@@ -0,0 +1,30 @@
+"""
+Tile corner images for building terrain masks.
+"""
+
+from PIL import Image
+
+# Transposes of the corner images for the tile corners NW, SW, NE and SE
+ORIENTATIONS = (None, Image.FLIP_TOP_BOTTOM, Image.FLIP_LEFT_RIGHT,
+                Image.ROTATE_180)
+
+# Corner images in every orientation, keyed by their file names
+_corners = {}
+
+def load_corners(imgs):
+    """
+    Open the small, medium and big corner images, return each of them in the
+    orientations of the four tile corners. Each set of files is opened and
+    transposed only once per process, so mask sets made from the same
+    corners with different backgrounds share them.
+    """
+    key = tuple(imgs)
+    if key not in _corners:
+        corners = []
+        for name in imgs:
+            img = Image.open(name)
+            img.load()
+            corners.append([img if i is None else img.transpose(i)
+                            for i in ORIENTATIONS])
+        _corners[key] = corners
+    return _corners[key]
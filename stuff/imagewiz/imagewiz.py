@@ -1,111 +1,17 @@
 #!/usr/bin/env python
 
 import argparse
-from PIL import Image, ImageChops
-import StringIO
-import subprocess
+import os
 import sys
 
+import compositor
+import instrument
+import manifest
 from palette import palettes
+import pngsave
+import resampler
 import tiq
-
-class ImageWiz(object):
-    """"""
-
-    def __init__(self, img, layers=None):
-        if '.xcf' in img:
-            img = self._xcf_to_png(img, layers)
-        self.img = Image.open(img)
-
-    def _xcf_to_png(self, img, layers):
-        """Convert xcf file to png with xcf2png"""
-        args = ['xcf2png', '--autocrop', '{0}'.format(img)]
-        if layers:
-            args.extend(layers)
-        print args
-        img = subprocess.Popen(args, stdout=subprocess.PIPE)
-        img = img.stdout.read()
-        img = StringIO.StringIO(img)
-        return img
-
-    def autocrop(self):
-        """Autocrop transparency from image, return offsets."""
-        bbox = self.img.getbbox()
-        self.img = self.img.crop(bbox)
-        # Only the coordinates from top left corner are needed for ttd offset
-        # purposes
-        return bbox[0:2]
-
-    def composite(self, img2, mode='over'):
-        """
-        Various alpha compositing methods.
-
-        Over: paste img2 over the current image.
-        In: multiply the alpha values of the current image and img2, set this
-        alpha for the current image.
-        """
-        img2 = Image.open(img2)
-        if mode == 'over':
-            self.img = Image.alpha_composite(self.img, img2)
-        elif mode == 'in':
-            alpha_1 = self.img.split()[3]
-            alpha_2 = img2.split()[3]
-            alpha_1 = ImageChops.multiply(alpha_1, alpha_2)
-            self.img.putalpha(alpha_1)
-        else:
-            print "Unknown mode: {0}".format(mode)
-            sys.exit()
-
-    def resize(self, size, mode='aa'):
-        """Resize image."""
-        modes = {'nearest': Image.NEAREST,
-                 'bilinear': Image.BILINEAR,
-                 'bicubic': Image.BICUBIC,
-                 'aa': Image.ANTIALIAS}
-        try:
-            size = float(size)
-            size = (int(round(self.img.size[0]*size)),
-                    int(round(self.img.size[1]*size)))
-        except ValueError:
-            if 'x' in size:
-                size = size.split('x')
-                if not size[0]:
-                    pct = int(size[1]) / float(self.img.size[1])
-                    size[0] = int(round(self.img.size[0]*pct))
-                elif not size[1]:
-                    pct = int(size[0]) / float(self.img.size[0])
-                    size[1] = int(round(self.img.size[1]*pct))
-                size = map(int, size)
-                    
-        # Resize method returns a copy
-        self.img = self.img.resize(size, modes[mode])
-
-
-    def reduce_alpha(self, value):
-        """
-        For every pixel with an alpha value higher than or equal to the
-        parameter value, increase alpha to 255. For every other pixel reduce
-        alpha to 0.
-        """
-        if self.img.mode == 'RGBA':
-            value = int(value)
-            # Get alpha band
-            alpha = self.img.split()[3]
-            alpha = alpha.point(lambda x: x >= value and 255)
-            self.img.putalpha(alpha)
-            # Transparent pixels still have color data. Change them to black.
-            alpha = alpha.convert('RGBA')
-            self.img = ImageChops.multiply(self.img, alpha)
-        else:
-            print "Image mode was not RGBA, no alpha reduced."
-
-    def to_8bpp(self, palette, ignored_colors=None):
-        """Convert to 8bpp ttd paletted image"""
-        self.img = tiq.main(self.img, palette, ignored_colors)
-
-    def save(self, name):
-        """Save image as optimized png"""
-        self.img.save(name, 'PNG', options='optimize')
+from wiz import ImageWiz, derive_zooms
 
 def parse_arguments():
 
@@ -116,7 +22,7 @@ def parse_arguments():
     class SizeAction(argparse.Action):
         """Custom action for size argument"""
         def __call__(self, parser, namespace, values, option_string=None):
-            valid_filters = ('nearest', 'bilinear', 'bicubic', 'aa')
+            valid_filters = tuple(sorted(resampler.FILTERS))
             if len(values) == 1:
                 filter_ = 'aa'
             else:
@@ -128,7 +34,7 @@ def parse_arguments():
     class CompositeAction(argparse.Action):
         """Custom action for size argument"""
         def __call__(self, parser, namespace, values, option_string=None):
-            valid_modes = ('over', 'in')
+            valid_modes = compositor.MODES
             if len(values) == 1:
                 mode = 'over'
             else:
@@ -173,7 +79,9 @@ def parse_arguments():
             "Composites two images together.\n\n"
             "Available modes:\n"
             "over (default)\n"
-            "in"))
+            "in\n"
+            "out\n"
+            "multiply (needs numpy)"))
 
     parser.add_argument('-s', '--resize', metavar=('size', 'filter'),
             nargs='+', action=SizeAction,
@@ -182,7 +90,8 @@ def parse_arguments():
                     "nearest\n"
                     "bilinear\n"
                     "bicubic\n"
-                    "antialias"))
+                    "aa (default, a box filter for whole reductions)\n"
+                    "lanczos (aa without the box filter)"))
 
     parser.add_argument('-a', '--reduce-alpha', metavar='threshold',
             help="Reduce alpha")
@@ -197,34 +106,76 @@ def parse_arguments():
             "dos (default), win, dos_toyland, win_toyland\n\n"
             "Additional flags:\n"
             "noact (no action colors)\n"
-            "nocc (no cc colors)")
+            "nocc (no cc colors)\n"
+            "fs (Floyd-Steinberg dithering)\n"
+            "ordered (ordered dithering)")
             .format(', '.join(palette_options)))
+
+    parser.add_argument('-R', '--remap-8bpp', nargs='+',
+            metavar=('palette', 'source'), help=(
+            "Move an 8bpp image to another palette without\n"
+            "requantizing. Company and action colors keep their\n"
+            "places. The source palette is found from the image\n"
+            "if not given.\n\n"
+            "Available palettes:\n"
+            "{0}").format(', '.join(palette_options)))
+
+    parser.add_argument('-q', '--quantizer', choices=tiq.METHODS, help=(
+            "Method used to find the closest palette colors in\n"
+            "8bpp conversion. By default the fastest available\n"
+            "method for the metric is used.\n\n"
+            "Available methods:\n"
+            "lut (lookup table, rgb metric only)\n"
+            "kdtree\n"
+            "sp\n"
+            "brute (rgb metric only)"))
+
+    parser.add_argument('-m', '--metric', choices=tiq.METRICS,
+            default='rgb', help=(
+            "Color distance used in 8bpp conversion.\n\n"
+            "Available metrics:\n"
+            "rgb (default, euclidean distance)\n"
+            "weighted (euclidean distance with channel weights)\n"
+            "lab (perceptual distance in CIE L*a*b*)"))
+    parser.add_argument('-P', '--png', choices=sorted(pngsave.PROFILES),
+            default='default', help=(
+            "PNG compression of the output file.\n\n"
+            "Available profiles:\n"
+            "fast (for intermediate files)\n"
+            "default\n"
+            "max (smallest files, slowest)"))
+
+    parser.add_argument('--no-cache', action='store_true', help=(
+            "Do the operations even if the same input and\n"
+            "operations have a cached result."))
+    parser.add_argument('--stats', choices=instrument.MODES, help=(
+            "Record the time and pixels of every operation.\n"
+            "table prints a summary, json writes JSON lines to\n"
+            "stderr or to the file in IMAGEWIZ_STATS_FILE."))
     args = parser.parse_args()
+    if args.stats:
+        instrument.enable(args.stats, os.environ.get('IMAGEWIZ_STATS_FILE'))
 
-    img = ImageWiz(args.infile, args.layers)
     print args
+    # The options are run as a manifest job, which shares the result cache
+    ops = []
     if args.composite:
-        img.composite(args.composite[0], args.composite[1])
+        ops.append(['composite', args.composite[0], args.composite[1]])
     if args.resize:
-        img.resize(args.resize[0], args.resize[1])
+        ops.append(['resize', args.resize[0], args.resize[1]])
     if args.reduce_alpha:
-        img.reduce_alpha(args.reduce_alpha)
+        ops.append(['reduce_alpha', args.reduce_alpha])
     if args.autocrop:
-        img.autocrop()
+        ops.append(['autocrop'])
     if args.palette_8bpp:
-        pal = palettes[args.palette_8bpp[0]]
-        # Parse optional arguments for 8bpp conversion
-        ignored_colors = []
-        if args.palette_8bpp[1]:
-            for i in args.palette_8bpp[1]:
-                if i == 'noact':
-                    ignored_colors.extend(pal.act)
-                elif i == 'nocc':
-                    ignored_colors.extend(pal.onecc)
-                else:
-                    raise Exception('Unknown option: {0}'.format(i))
-        img.to_8bpp(pal, ignored_colors)
-    img.save(args.outfile)
+        ops.append(['palette_8bpp', args.palette_8bpp[0]] +
+                args.palette_8bpp[1])
+    if args.remap_8bpp:
+        ops.append(['remap_8bpp'] + args.remap_8bpp)
+    job = manifest.parse_job({'infile': args.infile, 'outfile': args.outfile,
+                              'layers': args.layers, 'ops': ops,
+                              'png': args.png})
+    manifest.run_job(job, args.quantizer, args.metric, not args.no_cache)
         
 
 if __name__ == '__main__':
@@ -291,5 +242,14 @@ if __name__ == '__main__':
             olden_win.save('tester_8bpp_win.png')
             print('Conversion of {0} to win 8bpp successful!').format(tester)
 
+        elif sys.argv[1] == 'batch':
+            # Run the jobs of manifest files
+            sys.exit(manifest.main(sys.argv[2:]))
+
+        elif sys.argv[1] == 'zooms':
+            # zooms infile outbase [palette] [flags]
+            palette = sys.argv[4] if len(sys.argv) > 4 else 'dos'
+            derive_zooms(sys.argv[2], sys.argv[3], palette, sys.argv[5:])
+
         else:
             parse_arguments()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""
+Timing and counters for the image pipeline.
+
+Operations decorated with timed record their wall time and the amount of
+pixels they handled, and can add counters of their own with count. Nothing
+is recorded unless instrumentation is enabled, either with enable or by
+setting the IMAGEWIZ_STATS environment variable to one of:
+
+table: print a summary table of all operations at exit
+json: write every operation as a JSON line at exit
+
+The JSON lines go to stderr, or are appended to the file named by the
+IMAGEWIZ_STATS_FILE environment variable. Running this module with such
+files as arguments prints the summary table of all of them, which is handy
+for seeing where a whole build spent its time.
+"""
+
+import atexit
+import functools
+import json
+import os
+import sys
+import time
+
+MODES = ('table', 'json')
+
+_mode = None
+_output = None
+# Operations currently running, innermost last
+_stack = []
+# Every recorded operation as a dict
+_events = []
+# Functions called with every recorded operation
+_hooks = []
+
+def enable(mode='table', output=None):
+    """
+    Start recording. mode is one of MODES, output is a file name for the
+    json mode.
+    """
+    global _mode, _output
+    if mode not in MODES:
+        raise ValueError('Unknown stats mode: {0}'.format(mode))
+    if _mode is None:
+        atexit.register(report)
+    _mode = mode
+    _output = output
+
+def enabled():
+    """True if operations are being recorded"""
+    return _mode is not None or bool(_hooks)
+
+def add_hook(hook):
+    """Call hook with the dict of every recorded operation"""
+    _hooks.append(hook)
+
+def count(key, value=1):
+    """Add to a counter of the operation currently running"""
+    if _stack:
+        counters = _stack[-1]['counters']
+        counters[key] = counters.get(key, 0) + value
+
+def pixels_of(args):
+    """
+    Amount of pixels in the first argument which is an image, an ImageWiz
+    object or a list or dict of either.
+    """
+    for arg in args:
+        if isinstance(arg, dict):
+            arg = list(arg.values())
+        if isinstance(arg, (list, tuple)):
+            # Only look further if the first item is an image, the argument
+            # might as well be a long list of colors
+            if arg and pixels_of(arg[:1]) is not None:
+                return sum(pixels_of([i]) or 0 for i in arg)
+            continue
+        # ImageWiz objects tell their size without applying pending work
+        size = getattr(arg, 'size', None)
+        if not isinstance(size, tuple):
+            size = getattr(getattr(arg, 'img', None), 'size', None)
+        if isinstance(size, tuple) and len(size) == 2:
+            return size[0] * size[1]
+    return None
+
+def timed(name):
+    """Decorator recording the calls of a function as operation name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            event = {'op': name, 'pixels': pixels_of(args), 'counters': {}}
+            _stack.append(event)
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                event['seconds'] = time.time() - start
+                _stack.pop()
+                record(event)
+        return wrapper
+    return decorator
+
+def record(event):
+    """Store a finished operation and pass it to the hooks"""
+    event['pid'] = os.getpid()
+    _events.append(event)
+    for hook in _hooks:
+        hook(event)
+
+def take():
+    """Return the operations recorded so far and forget them"""
+    events = _events[:]
+    del _events[:]
+    return events
+
+def merge(events):
+    """Add operations recorded by another process, like a pool worker"""
+    _events.extend(events)
+    for event in events:
+        for hook in _hooks:
+            hook(event)
+
+def summary(events):
+    """Totals of the events per operation, sorted by total time"""
+    totals = {}
+    for event in events:
+        total = totals.setdefault(event['op'], {'op': event['op'], 'calls': 0,
+                'seconds': 0.0, 'pixels': 0, 'counters': {}})
+        total['calls'] += 1
+        total['seconds'] += event['seconds']
+        total['pixels'] += event.get('pixels') or 0
+        for key, value in event['counters'].items():
+            total['counters'][key] = total['counters'].get(key, 0) + value
+    return sorted(totals.values(), key=lambda i: -i['seconds'])
+
+def format_counters(counters):
+    """Counters as text, with hit rates for hits and misses counters"""
+    parts = ['{0}={1}'.format(key, counters[key]) for key in sorted(counters)]
+    hits = counters.get('hits', 0)
+    misses = counters.get('misses', 0)
+    if hits + misses:
+        parts.append('hit_rate={0:.1%}'.format(hits / float(hits + misses)))
+    return ' '.join(parts)
+
+def print_table(events, out=sys.stderr):
+    """Print the summary table of the events"""
+    out.write('{0:<28} {1:>6} {2:>10} {3:>12} {4:>9}  {5}\n'.format(
+            'operation', 'calls', 'total ms', 'pixels', 'Mpx/s', 'counters'))
+    for total in summary(events):
+        speed = ''
+        if total['pixels'] and total['seconds']:
+            speed = '{0:.2f}'.format(total['pixels'] / total['seconds'] / 1e6)
+        out.write('{0:<28} {1:>6} {2:>10.2f} {3:>12} {4:>9}  {5}\n'.format(
+                total['op'], total['calls'], total['seconds'] * 1000,
+                total['pixels'], speed, format_counters(total['counters'])))
+
+def write_json(events, out):
+    """Write the events as JSON lines"""
+    for event in events:
+        out.write(json.dumps(event, sort_keys=True) + '\n')
+
+def report():
+    """Output what was recorded, in the chosen mode"""
+    if _mode == 'table':
+        print_table(_events)
+    elif _mode == 'json':
+        if _output:
+            with open(_output, 'a') as f:
+                write_json(_events, f)
+        else:
+            write_json(_events, sys.stderr)
+
+if os.environ.get('IMAGEWIZ_STATS'):
+    enable(os.environ['IMAGEWIZ_STATS'], os.environ.get('IMAGEWIZ_STATS_FILE'))
+
+if __name__ == '__main__':
+    # Summarize JSON lines files written by earlier runs
+    events = []
+    for name in sys.argv[1:]:
+        with open(name) as f:
+            events.extend(json.loads(line) for line in f if line.strip())
+    print_table(events, sys.stdout)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+"""
+Run the ImageWiz operation chains of many images in one process, or spread
+them over a pool of worker processes.
+
+A manifest lists jobs, each with an input file, an output file and the
+operations done in between. Palettes, lookup tables and overlay images are
+loaded once and shared by all the jobs, instead of once per imagewiz call.
+
+A JSON manifest is a list of jobs:
+
+[{"infile": "sprite.xcf", "outfile": "sprite_8bpp.png",
+  "layers": ["body", "cc"],
+  "ops": [["resize", "0.25"], ["autocrop"], ["palette_8bpp", "dos", "noact"]]}]
+
+Jobs may also set "quantizer" and "metric" for the 8bpp conversion, and
+"png" to one of the pngsave profiles for the output. A CSV
+manifest has one job per row: the input file, the output file and then one
+operation per column with its arguments separated by spaces, like
+"resize 0.25 aa". Rows starting with # are skipped.
+
+The operations take the same arguments as the imagewiz options:
+
+composite image [mode]
+layers image mode [image mode ...]
+resize size [filter]
+reduce_alpha threshold
+autocrop
+palette_8bpp [palette] [flags]
+remap_8bpp palette [source]
+
+With more than one process, the palettes, lookup tables and color caches the
+jobs need are loaded before the workers start, and every worker prepares
+them again in case they weren't inherited. The results come back in the
+order of the jobs regardless of which worker finished first.
+
+Results are served from the cache of resultcache when the input, overlays and
+operations of a job are unchanged.
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import sys
+
+import compositor
+import instrument
+from wiz import ImageWiz, open_image, parse_palette_flags
+from palette import palettes
+import pngsave
+import resampler
+import resultcache
+import tiq
+
+# Operations with their smallest and largest amount of arguments
+OPERATIONS = {'composite': (1, 2),
+              'layers': (2, None),
+              'resize': (1, 2),
+              'reduce_alpha': (1, 1),
+              'autocrop': (0, 0),
+              'palette_8bpp': (0, None),
+              'remap_8bpp': (1, 2)}
+COMPOSITE_MODES = compositor.MODES
+RESIZE_FILTERS = tuple(sorted(resampler.FILTERS))
+
+# Overlay images once opened, keyed by file name
+_overlays = {}
+
+def parse_op(op):
+    """Check an operation, given as a list or a string, return it as a list"""
+    if not isinstance(op, list):
+        op = str(op).split()
+    if not op or op[0] not in OPERATIONS:
+        raise ValueError('Unknown operation: {0}'.format(op))
+    name, args = op[0], op[1:]
+    least, most = OPERATIONS[name]
+    if len(args) < least or (most is not None and len(args) > most):
+        raise ValueError('Wrong amount of arguments: {0}'.format(op))
+    if name == 'composite' and len(args) > 1 and \
+            args[1] not in COMPOSITE_MODES:
+        raise ValueError('Invalid mode: {0}'.format(args[1]))
+    if name == 'layers':
+        if len(args) % 2:
+            raise ValueError('Layers need an image and a mode: {0}'.format(op))
+        for i in args[1::2]:
+            if i not in COMPOSITE_MODES:
+                raise ValueError('Invalid mode: {0}'.format(i))
+    if name == 'resize' and len(args) > 1 and args[1] not in RESIZE_FILTERS:
+        raise ValueError('Invalid filter: {0}'.format(args[1]))
+    if name == 'reduce_alpha':
+        try:
+            int(args[0])
+        except ValueError:
+            raise ValueError('Invalid threshold: {0}'.format(args[0]))
+    if name == 'palette_8bpp':
+        # Raises on unknown flags
+        palette_args(args)
+    if name == 'remap_8bpp':
+        for i in args:
+            if i not in palettes:
+                raise ValueError('Invalid palette: {0}'.format(i))
+    return op
+
+def parse_job(job):
+    """Check a job read from a manifest"""
+    for key in ('infile', 'outfile'):
+        if not job.get(key):
+            raise ValueError('Job without {0}: {1}'.format(key, job))
+    job = dict(job)
+    job['ops'] = [parse_op(i) for i in job.get('ops') or []]
+    if job.get('quantizer') not in (None,) + tiq.METHODS:
+        raise ValueError('Unknown quantizer: {0}'.format(job['quantizer']))
+    if job.get('metric') not in (None,) + tiq.METRICS:
+        raise ValueError('Unknown metric: {0}'.format(job['metric']))
+    if job.get('png') not in (None,) + tuple(pngsave.PROFILES):
+        raise ValueError('Unknown png profile: {0}'.format(job['png']))
+    return job
+
+def read_manifest(path):
+    """Read the jobs of a JSON or CSV manifest"""
+    with open(path) as f:
+        if os.path.splitext(path)[1].lower() == '.json':
+            jobs = json.load(f)
+        else:
+            jobs = []
+            for row in csv.reader(f):
+                row = [i.strip() for i in row]
+                if not row or not row[0] or row[0].startswith('#'):
+                    continue
+                jobs.append({'infile': row[0],
+                             'outfile': row[1] if len(row) > 1 else None,
+                             'ops': [i for i in row[2:] if i]})
+    return [parse_job(i) for i in jobs]
+
+def palette_args(args):
+    """
+    Palette, ignored colors and dithering mode of a palette_8bpp operation.
+    Like the command line option, the palette name is optional.
+    """
+    if args and args[0] in palettes:
+        pal, flags = palettes[args[0]], args[1:]
+    else:
+        pal, flags = palettes['dos'], args
+    ignored_colors, dither = parse_palette_flags(pal, flags)
+    return pal, ignored_colors, dither
+
+def prepare(jobs, quantizer=None, metric='rgb'):
+    """Load the palettes, tables and overlays the jobs need"""
+    for job in jobs:
+        for op in job['ops']:
+            name, args = op[0], op[1:]
+            if name == 'composite':
+                get_overlay(args[0])
+            elif name == 'layers':
+                for i in args[::2]:
+                    get_overlay(i)
+            elif name == 'palette_8bpp':
+                pal, ignored_colors, dither = palette_args(args)
+                tiq.prepare(pal, ignored_colors,
+                        job.get('quantizer', quantizer),
+                        job.get('metric') or metric)
+
+def get_overlay(name):
+    """Open an image used for compositing, only once per file"""
+    if name not in _overlays:
+        img = open_image(name)
+        img.load()
+        _overlays[name] = img
+    return _overlays[name]
+
+@instrument.timed('manifest.job')
+def run_job(job, quantizer=None, metric='rgb', cache=True):
+    """
+    Do the operations of a job and save the result. Return the job with the
+    autocrop offsets added, or None for them if the image wasn't cropped.
+    With cache, a result of the same job done earlier is used if found.
+    """
+    result = dict(job)
+    key = None
+    if cache:
+        key = resultcache.job_key(job, quantizer, metric)
+        data = resultcache.fetch(key, job['outfile'])
+        if data is not None:
+            instrument.count('hits')
+            offsets = data['offsets']
+            result['offsets'] = tuple(offsets) if offsets else None
+            return result
+        instrument.count('misses')
+    img = ImageWiz(job['infile'], job.get('layers'))
+    quantizer = job.get('quantizer', quantizer)
+    metric = job.get('metric') or metric
+    offsets = None
+    for op in job['ops']:
+        name, args = op[0], op[1:]
+        if name == 'composite':
+            img.composite(get_overlay(args[0]), *args[1:])
+        elif name == 'layers':
+            img.composite_layers([(get_overlay(i), mode)
+                                  for i, mode in zip(args[::2], args[1::2])])
+        elif name == 'resize':
+            img.resize(*args)
+        elif name == 'reduce_alpha':
+            img.reduce_alpha(*args)
+        elif name == 'autocrop':
+            offsets = img.autocrop()
+        elif name == 'palette_8bpp':
+            pal, ignored_colors, dither = palette_args(args)
+            img.to_8bpp(pal, ignored_colors, quantizer, metric, dither)
+        elif name == 'remap_8bpp':
+            src = palettes[args[1]] if len(args) > 1 else None
+            img.remap_8bpp(palettes[args[0]], src)
+    img.save(job['outfile'], job.get('png') or 'default')
+    if key is not None:
+        resultcache.store(key, job['outfile'], {'offsets': offsets})
+    result['offsets'] = offsets
+    return result
+
+def init_worker(jobs, quantizer, metric):
+    """Set up a worker process of the pool"""
+    # Operations recorded before the fork belong to the parent
+    instrument.take()
+    prepare(jobs, quantizer, metric)
+    # Workers don't run atexit functions, but they do run finalizers
+    multiprocessing.util.Finalize(None, tiq.save_caches, exitpriority=0)
+
+def work(args):
+    """Run a job in a worker, return its result and recorded operations"""
+    result = run_job(*args)
+    return result, instrument.take()
+
+def run(jobs, quantizer=None, metric='rgb', processes=1, cache=True):
+    """
+    Run jobs, return their results in the same order. processes is the size
+    of the worker pool, None for one worker per core.
+    """
+    results = run_pool(jobs, quantizer, metric, processes, cache)
+    if cache:
+        # Every process evicts by its own count of the cache size, which
+        # leaves out what the other workers stored
+        resultcache.evict()
+    return results
+
+def run_pool(jobs, quantizer, metric, processes, cache):
+    """Run jobs in this process or on a pool of workers"""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(jobs))
+    if processes <= 1:
+        return [run_job(i, quantizer, metric, cache) for i in jobs]
+    # Load everything shared once, so that forked workers inherit it
+    prepare(jobs, quantizer, metric)
+    pool = multiprocessing.Pool(processes, init_worker,
+            (jobs, quantizer, metric))
+    try:
+        results = []
+        for result, events in pool.imap(work,
+                [(i, quantizer, metric, cache) for i in jobs]):
+            instrument.merge(events)
+            results.append(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+            'Run the ImageWiz jobs of JSON or CSV manifests.')
+    parser.add_argument('manifests', nargs='+', help=
+            'Manifest files, .json for JSON and anything else for CSV.')
+    parser.add_argument('-q', '--quantizer', choices=tiq.METHODS, help=
+            'Quantizer for jobs which do not set one.')
+    parser.add_argument('-m', '--metric', choices=tiq.METRICS,
+            default='rgb', help='Metric for jobs which do not set one.')
+    parser.add_argument('-P', '--png', choices=sorted(pngsave.PROFILES),
+            default='default', help=
+            'PNG profile for jobs which do not set one.')
+    parser.add_argument('-j', '--jobs', type=int, help=
+            'Worker processes. Default is one per core.')
+    parser.add_argument('--no-cache', action='store_true', help=
+            'Do every job, without using or storing cached results.')
+    parser.add_argument('--stats', choices=instrument.MODES, help=
+            'Record the time and pixels of every operation.')
+    args = parser.parse_args(argv)
+    if args.stats:
+        instrument.enable(args.stats, os.environ.get('IMAGEWIZ_STATS_FILE'))
+
+    # Read everything first, so that a broken manifest fails before any work
+    jobs = []
+    for path in args.manifests:
+        jobs.extend(read_manifest(path))
+    for job in jobs:
+        job.setdefault('png', args.png)
+    run(jobs, args.quantizer, args.metric, args.jobs, not args.no_cache)
+    print('{0} jobs done'.format(len(jobs)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
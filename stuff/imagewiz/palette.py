@@ -1,6 +1,43 @@
+import os
+import struct
+
 from PIL import Image
 
-from ttd_palette_data import ttd_palette_data as ttd_palettes
+from atomicfile import write_cache
+
+# The TTD palette data is read from a compact binary cache, which is rebuilt
+# from ttd_palette_data.py whenever that is newer
+PALETTE_PATH = os.path.dirname(os.path.abspath(__file__))
+PALETTE_SOURCE = os.path.join(PALETTE_PATH, 'ttd_palette_data.py')
+PALETTE_CACHE = os.path.join(PALETTE_PATH, 'ttd_palette_data.bin')
+PALETTE_CACHE_MAGIC = b'TTDPAL1\n'
+
+# Palette index ranges of the TTD palettes
+DOS_RANGES = {'bg': 0,
+              'neutral': ((1, 197), (206, 214)),
+              'twocc': (80, 87),
+              'onecc': (198, 205),
+              'act': (227, 254),
+              'white': 255}
+
+WIN_RANGES = {'bg': 0,
+              'neutral': ((10, 197), (206, 216), (245, 245)),
+              'twocc': (80, 87),
+              'onecc': (198, 205),
+              'act': (217, 244),
+              'white': 255}
+
+TTD_RANGES = {'dos': DOS_RANGES,
+              'win': WIN_RANGES,
+              'dos_toyland': DOS_RANGES,
+              'win_toyland': WIN_RANGES}
+
+# Colors of the TTD palettes once read, keyed by name
+_ttd_colors = {}
+# Palette to palette remap tables, keyed by the keys of the palettes
+_remap_tables = {}
+# Ranges which are mapped position by position when remapping
+REMAP_RANGES = ('bg', 'onecc', 'twocc', 'act', 'white')
 
 class Palette(object):
     """Palette object"""
@@ -15,58 +52,283 @@ class Palette(object):
         self.act = self.get_range(palette, act)
         self.white = palette[white]
 
+        # Precompiled lookups
+        # Reverse lookup from color to palette index. If a color appears more
+        # than once, the first index is used like list.index would.
+        self.color_index = {}
+        for i, color in enumerate(palette):
+            self.color_index.setdefault(color, i)
+        # Palette indices of each range
+        self.ranges = {'bg': (bg,),
+                       'neutral': self.get_range_indices(neutral),
+                       'onecc': self.get_range_indices(onecc),
+                       'twocc': self.get_range_indices(twocc),
+                       'act': self.get_range_indices(act),
+                       'white': (white,)}
+        self.neutral_indices = self.ranges['neutral']
+        # 256 entry masks of each range
+        self.masks = dict((name, self.mask(indices))
+                          for name, indices in self.ranges.items())
+        # Colors and ranges, for keying caches of things derived from them.
+        # Palettes can be replaced in the registry, so the object itself is
+        # not a safe key.
+        self.key = (tuple(self.raw), tuple(sorted(self.ranges.items())))
+        # Targets objects, keyed by ignored colors
+        self._targets = {}
+
+    def index_of(self, color):
+        """Palette index of a color"""
+        return self.color_index[color]
+
+    def mask(self, indices):
+        """
+        List of 256 booleans which are true for the given indices. It is a
+        plain list so that importing palette doesn't import numpy.
+        """
+        mask = [False] * 256
+        for i in indices:
+            mask[i] = True
+        return mask
+
+    def ignored_colors(self, flags):
+        """Colors to leave out of the no quant colors for the given flags"""
+        ignored = []
+        for flag in flags:
+            if flag == 'noact':
+                ignored.extend(self.act)
+            elif flag == 'nocc':
+                ignored.extend(self.onecc)
+            else:
+                raise ValueError('Unknown option: {0}'.format(flag))
+        return ignored
+
+    def targets(self, ignored_colors=None):
+        """Targets for a set of ignored colors, built once per set"""
+        key = tuple(sorted(set(ignored_colors or ())))
+        if key not in self._targets:
+            self._targets[key] = Targets(self, key)
+        return self._targets[key]
+
+    def targets_for_flags(self, flags):
+        """Targets for a combination of flags like noact and nocc"""
+        return self.targets(self.ignored_colors(flags))
+
     def flatten_palette(self, palette):
         """Flatten the palette from a list of 3-tuples to a list of ints."""
         return [i[j] for i in palette for j in range(len(i))]
 
     def get_range(self, palette, args):
         """Define a range, or combine ranges from the palette"""
-        pal_out = []
-        # Since python a:b slice notation does not include b, add +1 to the end
-        # range because we want to give precise palette indices as arguments.
+        return [palette[i] for i in self.get_range_indices(args)]
+
+    def get_range_indices(self, args):
+        """Palette indices of a range, or of combined ranges"""
+        indices = []
+        # Since python range does not include the end, add +1 to the end
+        # because we want to give precise palette indices as arguments.
         if isinstance(args[0], tuple):
             for arg in args:
-                pal_out.extend(palette[arg[0]:arg[1]+1])
+                indices.extend(range(arg[0], arg[1]+1))
         else:
-            pal_out.extend(palette[args[0]:args[1]+1])
-        return pal_out
-
-dos = Palette(palette=ttd_palettes['dos'],
-                 bg=0,
-                 neutral=((1, 197), (206, 214)),
-                 twocc=(80, 87),
-                 onecc=(198, 205),
-                 act=(227, 254),
-                 white=255)
-
-win = Palette(palette=ttd_palettes['win'],
-                 bg=0,
-                 neutral=((10, 197), (206, 216), (245, 245)),
-                 twocc=(80, 87),
-                 onecc=(198, 205),
-                 act=(217, 244),
-                 white=255)
-
-dos_toyland = Palette(palette=ttd_palettes['dos_toyland'],
-                 bg=0,
-                 neutral=((1, 197), (206, 214)),
-                 twocc=(80, 87),
-                 onecc=(198, 205),
-                 act=(227, 254),
-                 white=255)
-
-win_toyland = Palette(palette=ttd_palettes['win_toyland'],
-                 bg=0,
-                 neutral=((10, 197), (206, 216), (245, 245)),
-                 twocc=(80, 87),
-                 onecc=(198, 205),
-                 act=(217, 244),
-                 white=255)
-
-palettes = {'dos': dos, 'win': win,
-            'dos_toyland': dos_toyland, 'win_toyland': win_toyland}
+            indices.extend(range(args[0], args[1]+1))
+        return tuple(indices)
+
+class Targets(object):
+    """
+    The colors an image is quantized into, and the colors which are kept as
+    they are, for one set of ignored colors. The bg, company and action
+    colors and white are never quantized into, but pixels which have exactly
+    one of these colors keep it, unless the color is ignored.
+    """
+    def __init__(self, palette, ignored_colors):
+        ignored = set(ignored_colors)
+        no_quant = [palette.bg] + palette.onecc + palette.act + [palette.white]
+        self.no_quant_colors = tuple(i for i in no_quant if i not in ignored)
+        self.no_quant_indices = tuple(palette.color_index[i]
+                                      for i in self.no_quant_colors)
+        self.quant_colors = tuple(palette.neutral)
+        self.quant_indices = palette.neutral_indices
+        # Indices which may appear in a converted image
+        self.mask = palette.mask(self.quant_indices + self.no_quant_indices)
+
+class PaletteRegistry(object):
+    """
+    Palettes keyed by name. A palette is only constructed the first time it
+    is accessed, so that unused palettes cost nothing.
+    """
+    def __init__(self):
+        self._loaders = {}
+        self._ranges = {}
+        self._palettes = {}
+
+    def register(self, name, loader, ranges=None):
+        """
+        Add a palette. loader is a function returning the 256 colors of the
+        palette, ranges a dict of palette index ranges like DOS_RANGES, which
+        is also the default.
+        """
+        self._loaders[name] = loader
+        self._ranges[name] = ranges or DOS_RANGES
+        self._palettes.pop(name, None)
+
+    def register_file(self, name, path, ranges=None):
+        """Add a palette read from a palette file"""
+        self.register(name, lambda: load_palette_file(path), ranges)
+
+    def __getitem__(self, name):
+        if name not in self._palettes:
+            colors = self._loaders[name]()
+            self._palettes[name] = Palette(palette=colors,
+                                           **self._ranges[name])
+        return self._palettes[name]
+
+    def __contains__(self, name):
+        return name in self._loaders
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._loaders)
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def keys(self):
+        return sorted(self._loaders)
+
+    def values(self):
+        return [self[i] for i in self.keys()]
+
+    def items(self):
+        return [(i, self[i]) for i in self.keys()]
+
+def read_palette_cache():
+    """
+    Colors of the TTD palettes from the binary cache, or None if the cache
+    is missing or older than the palette source.
+
+    The cache is the magic string followed by, for each palette, the length
+    of its name, the name and 768 bytes of RGB values.
+    """
+    try:
+        if (os.path.exists(PALETTE_SOURCE) and os.path.getmtime(
+                PALETTE_SOURCE) > os.path.getmtime(PALETTE_CACHE)):
+            return None
+        with open(PALETTE_CACHE, 'rb') as f:
+            data = f.read()
+    except (IOError, OSError):
+        return None
+    if not data.startswith(PALETTE_CACHE_MAGIC):
+        return None
+    colors = {}
+    pos = len(PALETTE_CACHE_MAGIC)
+    while pos < len(data):
+        length = struct.unpack('B', data[pos:pos+1])[0]
+        name = data[pos+1:pos+1+length].decode('ascii')
+        values = bytearray(data[pos+1+length:pos+1+length+768])
+        if len(values) != 768:
+            return None
+        colors[name] = [tuple(values[i:i+3]) for i in range(0, 768, 3)]
+        pos += 1 + length + 768
+    return colors
+
+def write_palette_cache(colors):
+    """Write the colors of the TTD palettes to the binary cache"""
+    data = [PALETTE_CACHE_MAGIC]
+    for name in sorted(colors):
+        encoded = name.encode('ascii')
+        data.append(struct.pack('B', len(encoded)) + encoded)
+        data.append(bytes(bytearray(j for i in colors[name] for j in i)))
+    write_cache(PALETTE_CACHE, lambda f: f.write(b''.join(data)))
+
+def ttd_palette_colors(name):
+    """Colors of a TTD palette"""
+    if not _ttd_colors:
+        colors = read_palette_cache()
+        if colors is None:
+            # Only import the big palette literal when the cache is stale
+            from ttd_palette_data import ttd_palette_data as colors
+            write_palette_cache(colors)
+        _ttd_colors.update(colors)
+    return _ttd_colors[name]
+
+def load_palette_file(path):
+    """
+    Read 256 colors from a palette file. JASC-PAL and GIMP palettes, Adobe
+    color tables and paletted images are supported. Missing colors are
+    filled with black.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    colors = []
+    if data.startswith(b'JASC-PAL'):
+        # Header, version and color count, then one color per line
+        for line in data.decode('ascii').splitlines()[3:]:
+            if line.strip():
+                colors.append(tuple(int(i) for i in line.split()[:3]))
+    elif data.startswith(b'GIMP Palette'):
+        for line in data.decode('utf-8').splitlines()[1:]:
+            values = line.split()
+            # Skip name, columns and comment lines
+            if len(values) >= 3 and all(i.isdigit() for i in values[:3]):
+                colors.append(tuple(int(i) for i in values[:3]))
+    elif os.path.splitext(path)[1].lower() == '.act' and len(data) in (768,
+            772):
+        values = bytearray(data[:768])
+        colors = [tuple(values[i:i+3]) for i in range(0, 768, 3)]
+    else:
+        img = Image.open(path)
+        if img.mode != 'P':
+            raise ValueError('Not a palette file: {0}'.format(path))
+        values = img.getpalette()
+        colors = [tuple(values[i:i+3]) for i in range(0, len(values), 3)]
+    colors = colors[:256]
+    colors.extend([(0, 0, 0)] * (256 - len(colors)))
+    return colors
+
+def remap_table(src, dst):
+    """
+    Table of 256 palette indices of dst, one for every palette index of src.
+
+    The bg, company color, action color and white ranges are mapped position
+    by position, so that an index in one of them ends up in the same place of
+    the same range in dst. Every other index is mapped to the closest neutral
+    color of dst.
+    """
+    key = (src.key, dst.key)
+    if key in _remap_tables:
+        return _remap_tables[key]
+    table = [None] * 256
+    for name in REMAP_RANGES:
+        for i, j in zip(src.ranges[name], dst.ranges[name]):
+            if table[i] is None:
+                table[i] = j
+    for i, color in enumerate(src.full):
+        if table[i] is None:
+            table[i] = min(dst.neutral_indices, key=lambda j: (
+                    sum((a - b)**2 for a, b in zip(color, dst.full[j])), j))
+    _remap_tables[key] = table
+    return table
+
+def find_palette(raw):
+    """Name of the registered palette with this flattened palette, or None"""
+    raw = list(raw[:768])
+    for name in palettes:
+        if palettes[name].raw == raw:
+            return name
+    return None
+
+palettes = PaletteRegistry()
+for ttd_name in TTD_RANGES:
+    palettes.register(ttd_name,
+                      lambda name=ttd_name: ttd_palette_colors(name),
+                      TTD_RANGES[ttd_name])
 
 if __name__=='__main__':
+    dos = palettes['dos']
     print dos.full
     print
     print dos.raw
@@ -75,7 +337,7 @@ if __name__=='__main__':
     print
     print dos.neutral
     print
-    print dos.cc
+    print dos.onecc
     print
     print dos.act
     print
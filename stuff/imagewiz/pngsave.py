@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+"""
+PNG saving with selectable profiles.
+
+fast: low zlib level, for intermediate files which are read back right away
+default: what PIL does by default
+max: the best compression PIL can do, for final sprites
+
+With the fast profile, large images are compressed on several threads when
+numpy is available. The image is cut into blocks of rows, which are deflated
+separately and joined into one zlib stream, in the same way as pigz does.
+The rows are only Sub filtered, which makes larger files than the adaptive
+filtering of PIL, so the other profiles always use PIL.
+"""
+
+import multiprocessing
+import struct
+import threading
+import zlib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import instrument
+
+# Options of PIL's PNG encoder for the profiles
+PROFILES = {'fast': {'compress_level': 1},
+            'default': {},
+            'max': {'optimize': True}}
+# Profiles the parallel encoder is used for, with their zlib levels
+LEVELS = {'fast': 1}
+# Images with at least this many pixels are compressed in parallel
+PARALLEL_PIXELS = 1 << 20
+# Bytes of raw image data deflated as one block
+BLOCK_SIZE = 1 << 18
+# PNG color types of the image modes the parallel encoder supports
+COLOR_TYPES = {'L': 0, 'RGB': 2, 'P': 3, 'LA': 4, 'RGBA': 6}
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+@instrument.timed('pngsave.save')
+def save(img, name, profile='default', threads=None):
+    """
+    Save an image as png with a profile, using threads for large images.
+    threads is None for one thread per core.
+    """
+    if profile not in PROFILES:
+        raise ValueError('Unknown png profile: {0}'.format(profile))
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if (np is not None and threads > 1 and profile in LEVELS and
+            img.size[0] * img.size[1] >= PARALLEL_PIXELS and
+            can_encode(img)):
+        with open(name, 'wb') as f:
+            f.write(encode(img, profile, threads))
+    else:
+        img.save(name, 'PNG', **PROFILES[profile])
+
+def can_encode(img):
+    """
+    Whether the parallel encoder can write an image. Of the transparency
+    PIL can save, it only writes a single transparent palette index.
+    """
+    if img.mode not in COLOR_TYPES:
+        return False
+    transparency = img.info.get('transparency')
+    return transparency is None or (img.mode == 'P' and
+            isinstance(transparency, int))
+
+def chunk(kind, data):
+    """A PNG chunk"""
+    return (struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+def scanlines(img, filter_type):
+    """Raw image data with a filter type byte in front of every row"""
+    pixels = np.asarray(img, dtype=np.uint8)
+    height = img.size[1]
+    rows = pixels.reshape(height, -1)
+    if filter_type == 1:
+        # Sub filter, every byte minus the same byte of the previous pixel
+        bpp = pixels.shape[2] if pixels.ndim == 3 else 1
+        filtered = rows.copy()
+        filtered[:, bpp:] -= rows[:, :-bpp]
+        rows = filtered
+    lines = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    lines[:, 0] = filter_type
+    lines[:, 1:] = rows
+    return lines
+
+def deflate_block(data, level, last):
+    """Deflate one block as raw deflate data which ends on a byte boundary"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    flush = zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH
+    return compressor.compress(data) + compressor.flush(flush)
+
+def deflate_blocks(blocks, level, threads):
+    """Deflate blocks on threads, zlib lets other threads run meanwhile"""
+    deflated = [None] * len(blocks)
+    def work(first):
+        for i in range(first, len(blocks), threads):
+            deflated[i] = deflate_block(blocks[i], level,
+                    i == len(blocks) - 1)
+    workers = [threading.Thread(target=work, args=(i,))
+               for i in range(min(threads, len(blocks)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return deflated
+
+def encode(img, profile, threads):
+    """PNG file contents of an image, deflated on several threads"""
+    # Palette images are not filtered, it rarely helps them
+    lines = scanlines(img, 0 if img.mode == 'P' else 1)
+    rows = max(1, BLOCK_SIZE // lines.shape[1])
+    blocks = [lines[i:i + rows].tobytes()
+              for i in range(0, lines.shape[0], rows)]
+    deflated = deflate_blocks(blocks, LEVELS[profile], threads)
+    checksum = 1
+    for block in blocks:
+        checksum = zlib.adler32(block, checksum)
+    # zlib header for deflate with a 32K window and default compression
+    stream = (b'\x78\x9c' + b''.join(deflated) +
+              struct.pack('>I', checksum & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', img.size[0], img.size[1], 8,
+            COLOR_TYPES[img.mode], 0, 0, 0)
+    parts = [PNG_SIGNATURE, chunk(b'IHDR', header)]
+    if img.mode == 'P':
+        palette = img.getpalette()
+        parts.append(chunk(b'PLTE', struct.pack('768B', *palette[:768])))
+        transparency = img.info.get('transparency')
+        if isinstance(transparency, int):
+            parts.append(chunk(b'tRNS', b'\xff' * transparency + b'\x00'))
+    parts.append(chunk(b'IDAT', stream))
+    parts.append(chunk(b'IEND', b''))
+    return b''.join(parts)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Uncompressed image files for intermediate results.
+
+A raw image is a small header, the palette of P images and the pixels as
+PIL stores them, starting at a 64 byte boundary. Reading one maps the file
+into memory instead of decoding it, and PIL uses the mapped pixels directly
+for L, P and RGBA images. The image is read only, PIL copies it before
+changing it. Writing one is a plain write of the pixels, there is no
+compression. The file is replaced rather than overwritten, because
+overwriting a file which is still mapped crashes the process reading it.
+
+Files with the RAW_EXTENSION are read and written as raw images by ImageWiz,
+so only the final outputs need to be png.
+"""
+
+import mmap
+import struct
+
+from PIL import Image
+
+from atomicfile import atomic_write
+import instrument
+
+RAW_EXTENSION = '.iwraw'
+MAGIC = b'IWRAW1\n\x00'
+# Mode, width, height and palette length
+HEADER = struct.Struct('<4sIII')
+# Pixels start at a multiple of this
+ALIGN = 64
+MODES = ('L', 'P', 'RGB', 'RGBA')
+
+def is_raw(name):
+    """True for file names of raw images"""
+    return isinstance(name, basestring) and name.endswith(RAW_EXTENSION)
+
+def pixel_offset(palette_length):
+    """Position of the pixels in the file"""
+    end = len(MAGIC) + HEADER.size + palette_length
+    return (end + ALIGN - 1) // ALIGN * ALIGN
+
+@instrument.timed('rawimage.save')
+def save(img, name):
+    """Write an image as a raw image"""
+    if img.mode not in MODES:
+        raise ValueError('Unsupported mode for raw images: {0}'.format(
+                img.mode))
+    palette = b''
+    if img.mode == 'P':
+        palette = struct.pack('768B', *img.getpalette()[:768])
+    offset = pixel_offset(len(palette))
+    def write(f):
+        f.write(MAGIC)
+        f.write(HEADER.pack(img.mode.ljust(4).encode('ascii'), img.size[0],
+                img.size[1], len(palette)))
+        f.write(palette)
+        f.write(b'\x00' * (offset - f.tell()))
+        f.write(img.tobytes())
+    atomic_write(name, write)
+
+@instrument.timed('rawimage.open')
+def open_raw(name):
+    """Map a raw image file, return it as a read only image"""
+    with open(name, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(MAGIC)] != MAGIC:
+        raise IOError('Not a raw image: {0}'.format(name))
+    mode, width, height, palette_length = HEADER.unpack_from(data,
+            len(MAGIC))
+    mode = mode.decode('ascii').strip()
+    start = len(MAGIC) + HEADER.size
+    pixels = buffer(data, pixel_offset(palette_length))
+    # The image keeps the mapping alive
+    img = Image.frombuffer(mode, (width, height), pixels, 'raw', mode, 0, 1)
+    if palette_length:
+        img.putpalette(bytearray(data[start:start + palette_length]))
+    return img
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Content addressed cache of ImageWiz results.
+
+A job is keyed by the contents of its input and overlay files, its
+normalized operations and the sources of the code doing them, never by file
+times. Results are kept as files in the cache directory, and the least
+recently used ones are removed once the directory grows over its size limit.
+Every process counts the size of the directory at its first store and adds
+what it stores to that, so the directory is only listed again once the
+total is over the limit.
+
+The directory and limit can be set with the IMAGEWIZ_RESULT_CACHE and
+IMAGEWIZ_RESULT_CACHE_SIZE (in bytes) environment variables.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+from atomicfile import atomic_write, write_cache
+import rawimage
+
+CACHE_PATH = os.environ.get('IMAGEWIZ_RESULT_CACHE', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'result_cache'))
+CACHE_SIZE = int(os.environ.get('IMAGEWIZ_RESULT_CACHE_SIZE', 256 << 20))
+
+# Results change when any of these change
+CODE_FILES = ('compositor.py', 'manifest.py', 'palette.py', 'pngsave.py',
+              'rawimage.py', 'resampler.py', 'tiq.py', 'ttd_palette_data.py',
+              'wiz.py')
+
+# Extensions of the cached images
+IMAGE_EXTENSIONS = ('.png', rawimage.RAW_EXTENSION)
+
+# Size of the cached images as last counted by evict, plus the images stored
+# by this process since. None until the first store.
+_size = None
+
+# Digests of files already hashed during this run, keyed by file name,
+# modification time and size
+_digests = {}
+
+def file_digest(path):
+    """md5 hex digest of the contents of a file"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    if key not in _digests:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+def code_digest():
+    """Digest of the sources which produce the results"""
+    path = os.path.dirname(os.path.abspath(__file__))
+    return [file_digest(os.path.join(path, i)) for i in CODE_FILES]
+
+def job_key(job, quantizer=None, metric='rgb'):
+    """Cache key of a manifest job"""
+    ops = []
+    for op in job['ops']:
+        op = list(op)
+        if op[0] == 'composite':
+            # The overlay by its contents instead of its name
+            op[1] = file_digest(op[1])
+        elif op[0] == 'layers':
+            op[1::2] = [file_digest(i) for i in op[1::2]]
+        ops.append([str(i) for i in op])
+    data = [code_digest(), file_digest(job['infile']), job.get('layers'),
+            ops, job.get('quantizer', quantizer), job.get('metric') or metric,
+            job.get('png') or 'default', extension(job['outfile'])]
+    return hashlib.md5(json.dumps(data, sort_keys=True).encode('utf-8'))\
+            .hexdigest()
+
+def extension(outfile):
+    """Extension of the cached image of an output file, by its format"""
+    if rawimage.is_raw(outfile):
+        return rawimage.RAW_EXTENSION
+    return '.png'
+
+def entry(key, ext):
+    """File names of the image and info of a cache entry"""
+    base = os.path.join(CACHE_PATH, key)
+    return base + ext, base + '.json'
+
+def copier(source):
+    """Write function for atomicfile which copies a file"""
+    def copy(f):
+        with open(source, 'rb') as src:
+            shutil.copyfileobj(src, f)
+    return copy
+
+def fetch(key, outfile):
+    """
+    Copy a cached result to outfile. Return the info stored with it, or None
+    if the result is not cached.
+    """
+    image, info = entry(key, extension(outfile))
+    try:
+        with open(info) as f:
+            data = json.load(f)
+        # outfile may be mapped as a raw image, so it is replaced instead of
+        # overwritten
+        atomic_write(outfile, copier(image))
+        # The modification time tells which entries were used last
+        os.utime(image, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return data
+
+def store(key, outfile, data):
+    """Store outfile and its info in the cache, evict if it grew too large"""
+    global _size
+    image, info = entry(key, extension(outfile))
+    # The info goes last, it marks the entry as complete
+    if not write_cache(image, copier(outfile)):
+        return
+    write_cache(info, lambda f: json.dump(data, f), 'w')
+    try:
+        added = os.path.getsize(image)
+    except OSError:
+        added = 0
+    if _size is None or _size + added > CACHE_SIZE:
+        _size = evict()
+    else:
+        _size += added
+
+def evict(limit=None):
+    """
+    Remove the least recently used entries until the cache fits limit.
+    Return the size of the images left in the cache.
+    """
+    if limit is None:
+        limit = CACHE_SIZE
+    try:
+        names = [i for i in os.listdir(CACHE_PATH)
+                 if os.path.splitext(i)[1] in IMAGE_EXTENSIONS]
+    except OSError:
+        return 0
+    entries = []
+    total = 0
+    for name in names:
+        try:
+            stat = os.stat(os.path.join(CACHE_PATH, name))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size,
+                        os.path.splitext(name)))
+        total += stat.st_size
+    entries.sort()
+    for mtime, size, (key, ext) in entries:
+        if total <= limit:
+            break
+        for path in reversed(entry(key, ext)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        total -= size
+    return total
+
+if __name__ == '__main__':
+    # Shrink the cache to the given amount of bytes, or empty it
+    evict(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
@@ -1,15 +1,72 @@
 #!/usr/bin/python
 
 import argparse
+import atexit
 import collections
+import hashlib
 import math 
+import os
 from PIL import Image
 import sys
-import time
 
-def now(event):
-    """Print time elapsed so far with a variable message."""
-    print event, "after", time.time() - start_time, "seconds"
+from atomicfile import write_cache
+import instrument
+import palette as palette_module
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Bits per channel used by the lookup table grid. With 6 bits every grid cell
+# covers a 4x4x4 cube of RGB values.
+LUT_BITS = 6
+# Lookup tables and color caches are persisted next to the palette data,
+# unless another directory is set in the environment
+CACHE_PATH = os.environ.get('TIQ_CACHE_PATH',
+        os.path.dirname(os.path.abspath(__file__)))
+
+# Lookup tables built during this run, keyed by palette and ignored colors
+_luts = {}
+# Color caches used during this run, keyed by their file names
+_color_caches = {}
+# Palette coordinates and search trees, keyed by metric and palette colors
+_palette_coords = {}
+_palette_trees = {}
+
+# Quantization methods and color distance metrics accepted by main
+METHODS = ('lut', 'kdtree', 'sp', 'brute')
+METRICS = ('rgb', 'weighted', 'lab')
+
+# Channel weights of the weighted rgb metric, human eyes are most sensitive to
+# green and least to blue.
+RGB_WEIGHTS = (2.0, 4.0, 3.0)
+
+# Colors queried from a search tree at once, limits the size of the results
+KDTREE_CHUNK = 65536
+# Closest palette colors compared when breaking ties
+KDTREE_TIES = 4
+
+# Images with more pixels than this in total are quantized in strips by
+# batch, the strips have at most STRIP_PIXELS pixels to bound the working set
+STREAM_PIXELS = 1 << 22
+STRIP_PIXELS = 1 << 18
+
+# Dithering modes accepted by main
+DITHER_MODES = ('none', 'floyd-steinberg', 'ordered')
+# Side length of the ordered dithering threshold matrix, a power of two
+BAYER_SIZE = 8
+# Largest change in channel value added by ordered dithering, roughly the
+# distance between neighbouring palette colors
+BAYER_SPREAD = 24.0
+# Floyd-Steinberg error distribution as (row, column, weight)
+FS_WEIGHTS = ((0, 1, 7/16.0), (1, -1, 3/16.0), (1, 0, 5/16.0),
+              (1, 1, 1/16.0))
 
 def euc_distance(x, y):
     """Euclidean distance between two points in 3-dimensional space"""
@@ -17,21 +74,34 @@ def euc_distance(x, y):
     result = math.sqrt(formula)
     return result
 
+@instrument.timed('tiq.replace_colors')
 def replace_colors(img_in, palette, mapping):
     """
     Insert pixels into the new image, using a mapping to choose the best
     replacement from the TTD palette for each unique color.
     """
-    pixels_in = img_in.load()
-    # Flatten the palette from a list of 3-tuples to a list of integer values
-    img_out = Image.new('P', img_in.size, color=None)
+    if np is None:
+        img_out = Image.new('P', img_in.size, color=None)
+        img_out.putpalette(palette)
+        img_out.putdata([mapping[i] for i in img_in.getdata()])
+        return img_out
+    packed = pack_array(np.asarray(img_in, dtype=np.uint8))
+    keys = pack_array(np.array(list(mapping.keys()), dtype=np.uint8))
+    values = np.array(list(mapping.values()), dtype=np.uint8)
+    order = np.argsort(keys)
+    keys = keys[order]
+    values = values[order]
+    # Find the position of every pixel in the sorted keys, which is also the
+    # position of its palette index in values
+    positions = np.searchsorted(keys, packed).clip(0, len(keys) - 1)
+    missing = keys[positions] != packed
+    if missing.any():
+        raise KeyError(unpack(packed[missing][0]))
+    img_out = Image.fromarray(values[positions], 'P')
     img_out.putpalette(palette)
-    pixels_out = img_out.load()
-    for y in range(img_in.size[1]):
-        for x in range (img_in.size[0]):
-            pixels_out[x, y] = mapping[pixels_in[x, y]]
     return img_out
 
+@instrument.timed('tiq.convert')
 def convert(img, bg):
     """
     Force the image to RGB mode.
@@ -39,27 +109,39 @@ def convert(img, bg):
     For RGBA images, convert all transparent pixels to bg color.
     """
     if img.mode == 'RGBA':
-        pixels = img.load()
-        for y in range(img.size[1]):
-            for x in range (img.size[0]):
-                if pixels[x, y][3] < 255:
-                    pixels[x, y] = bg
-        img = img.convert('RGB')
+        # Only fully opaque pixels are kept, everything else is pasted over
+        # with the background color in one go
+        opaque = img.split()[3].point(lambda x: x == 255 and 255)
+        img_out = Image.new('RGB', img.size, bg)
+        img_out.paste(img.convert('RGB'), mask=opaque)
+        img = img_out
     else:
         img = img.convert('RGB')
     return img
 
+@instrument.timed('tiq.get_unique_colors')
 def get_unique_colors(img):
     """Make a list of all the unique colors in the image"""
     # getcolors returns (count, pixel) we don't care about the count, at least
     # not for now
     colors = [i[1] for i in img.getcolors(maxcolors=img.size[0]*img.size[1])]
+    instrument.count('unique_colors', len(colors))
     return colors
 
+@instrument.timed('tiq.indexify')
 def indexify(mapping, palette):
-    """Translate RGB values to palette indices"""
+    """
+    Translate RGB values to palette indices. palette is either a Palette
+    object or a list of colors.
+    """
+    color_index = getattr(palette, 'color_index', None)
+    if color_index is None:
+        # Reverse lookup where the first index of a color wins, like in
+        # list.index
+        color_index = dict((color, i) for i, color in
+                reversed(list(enumerate(palette))))
     for i in mapping:
-        mapping[i] = palette.index(mapping[i])
+        mapping[i] = color_index[mapping[i]]
     return mapping
 
 def quant_brute(colors, palette):
@@ -79,7 +161,7 @@ def quant_brute(colors, palette):
         mapping[color] = best_match
     return mapping
 
-def quant_sp(colors, palette):
+def quant_sp(colors, palette, metric='rgb'):
     """
     Calculate the closest match between the unique colors in the source image
     and the chosen TTD palette using numpy arrays and scipy spatial distance
@@ -94,8 +176,8 @@ def quant_sp(colors, palette):
         import numpy as np
         import scipy.spatial
 
-        colors_numpy = np.array(colors)
-        palette_numpy = np.array(palette)
+        colors_numpy = color_coords(colors, metric)
+        palette_numpy = palette_coords(palette, metric)
         # dists holds the values of all the distances between the points in
         # array 1 and array 2
         dists = scipy.spatial.distance.cdist(colors_numpy, palette_numpy,
@@ -108,6 +190,424 @@ def quant_sp(colors, palette):
             mapping[item] = palette[np.argmin(dists[index])]
         return mapping
 
+def quant_kdtree(colors, palette, metric='rgb'):
+    """
+    Calculate the closest match between the unique colors in the source image
+    and the chosen TTD palette using a k-d tree of the palette colors. Unlike
+    "sp", memory use does not grow with the amount of palette colors.
+    """
+    nearest = nearest_kdtree(colors, palette, metric)
+    mapping = {}
+    for index, item in enumerate(colors):
+        mapping[item] = palette[nearest[index]]
+    return mapping
+
+def nearest_kdtree(colors, palette, metric='rgb'):
+    """Array of the positions of the closest palette colors"""
+    tree = palette_tree(palette, metric)
+    coords = color_coords(colors, metric)
+    nearest = np.empty(len(coords), dtype=np.intp)
+    for start in range(0, len(coords), KDTREE_CHUNK):
+        nearest[start:start+KDTREE_CHUNK] = query_tree(tree,
+                coords[start:start+KDTREE_CHUNK], len(palette))
+    return nearest
+
+def query_tree(tree, coords, size):
+    """Positions of the closest colors in the search tree of size colors"""
+    dists, indices = tree.query(coords, k=KDTREE_TIES)
+    # On a tie, prefer the first palette color like the other methods. The
+    # tree does not calculate distances bit for bit like cdist, so allow for
+    # rounding errors.
+    ties = dists <= dists[:, :1] + 1e-9
+    indices[~ties] = size
+    return indices.min(axis=1)
+
+def rgb_to_lab(rgb):
+    """Convert an array of sRGB colors to CIE L*a*b* (D65 white point)"""
+    rgb = rgb / 255.0
+    linear = np.where(rgb > 0.04045, ((rgb + 0.055) / 1.055)**2.4,
+            rgb / 12.92)
+    xyz = linear.dot(np.array([[0.4124, 0.3576, 0.1805],
+                               [0.2126, 0.7152, 0.0722],
+                               [0.0193, 0.1192, 0.9505]]).T)
+    xyz /= np.array([0.95047, 1.0, 1.08883])
+    delta = 6 / 29.0
+    f = np.where(xyz > delta**3, np.cbrt(xyz),
+            xyz / (3 * delta**2) + 4 / 29.0)
+    return np.column_stack((116 * f[:, 1] - 16,
+                            500 * (f[:, 0] - f[:, 1]),
+                            200 * (f[:, 1] - f[:, 2])))
+
+def color_coords(colors, metric):
+    """
+    Coordinates of colors in the space of the chosen metric, where plain
+    euclidean distance gives the color difference.
+    """
+    coords = np.array(colors, dtype=np.float64).reshape(-1, 3)
+    if metric == 'rgb':
+        return coords
+    elif metric == 'weighted':
+        return coords * np.sqrt(RGB_WEIGHTS)
+    elif metric == 'lab':
+        return rgb_to_lab(coords)
+    else:
+        raise ValueError('Unknown metric: {0}'.format(metric))
+
+def palette_coords(palette, metric):
+    """Coordinates of the palette colors, calculated once per metric"""
+    key = (metric, tuple(palette))
+    if key not in _palette_coords:
+        _palette_coords[key] = color_coords(palette, metric)
+    return _palette_coords[key]
+
+def palette_tree(palette, metric):
+    """k-d tree of the palette colors, built once per metric"""
+    import scipy.spatial
+
+    key = (metric, tuple(palette))
+    if key not in _palette_trees:
+        _palette_trees[key] = scipy.spatial.cKDTree(
+                palette_coords(palette, metric))
+    return _palette_trees[key]
+
+def default_method():
+    """The best exact search method available"""
+    try:
+        __import__('numpy')
+        __import__('scipy')
+    except ImportError:
+        return 'brute'
+    else:
+        return 'kdtree'
+
+def search_packed(colors, palette, method=None, metric='rgb'):
+    """
+    Palette indices of the closest neutral palette colors for an array of
+    packed colors.
+    """
+    if method is None:
+        method = default_method()
+    if method == 'kdtree':
+        targets = np.array(palette.neutral_indices, dtype=np.int16)
+        return targets[nearest_kdtree(unpack_array(colors), palette.neutral,
+                metric)]
+    colors = [unpack(i) for i in colors]
+    mapping = indexify(quantize(colors, palette.neutral, method, metric),
+            palette)
+    return np.array([mapping[i] for i in colors], dtype=np.int16)
+
+@instrument.timed('tiq.quantize')
+def quantize(colors, palette, method=None, metric='rgb'):
+    """
+    Map each color to the closest palette color. Unless a method is given,
+    use the best one available.
+    """
+    if method is None:
+        method = default_method()
+    if method == 'kdtree':
+        return quant_kdtree(colors, palette, metric)
+    elif method == 'sp':
+        return quant_sp(colors, palette, metric)
+    elif method == 'brute':
+        if metric != 'rgb':
+            raise ValueError('Method brute only supports the rgb metric')
+        return quant_brute(colors, palette)
+    else:
+        raise ValueError('Unknown method: {0}'.format(method))
+
+class PaletteLUT(object):
+    """
+    Dense RGB to palette index lookup table.
+
+    The RGB cube is divided into a grid of cells. A cell stores a palette
+    index only if every color inside it has the same closest palette color,
+    the remaining cells are resolved exactly when a color falling in them is
+    looked up. This way the table gives the same results as quantizing every
+    color separately.
+    """
+
+    def __init__(self, palette, ignored_colors):
+        self.palette = palette
+        self.shift = 8 - LUT_BITS
+        self.grid = self.load_grid()
+        # Colors in ambiguous cells which have already been resolved, in
+        # this or any earlier run
+        self.resolved = get_color_cache(self.search, 'nearest',
+                palette.full, palette.neutral)
+        self.constant_keys, self.constant_values = constant_table(palette,
+                get_no_quant_colors(palette, ignored_colors))
+
+    def key(self):
+        """Hash of the palette contents the grid depends on"""
+        return cache_key(LUT_BITS, self.palette.full, self.palette.neutral)
+
+    def load_grid(self):
+        """Load the grid from disk, or build and save it if not found."""
+        path = os.path.join(CACHE_PATH, 'ttd_palette_lut_{0}.npy'.format(
+                self.key()))
+        size = 1 << LUT_BITS
+        try:
+            grid = np.load(path)
+        except (IOError, OSError, ValueError):
+            pass
+        else:
+            if grid.shape == (size, size, size):
+                return grid
+        grid = self.build_grid()
+        write_cache(path, lambda f: np.save(f, grid))
+        return grid
+
+    def build_grid(self):
+        """Calculate the palette index of every unambiguous grid cell"""
+        size = 1 << LUT_BITS
+        step = 1 << self.shift
+        neutral = self.palette.neutral
+        targets = np.array(self.palette.neutral_indices, dtype=np.int16)
+        pal = np.array(neutral, dtype=np.float64)
+        # Every color in a cell is at most this far away from the cell center.
+        # If the closest palette color is nearer than the second closest by
+        # more than twice this radius, it is the closest for the whole cell.
+        radius = math.sqrt(3) * (step - 1) / 2.0
+        centers = np.arange(size) * step + (step - 1) / 2.0
+        green, blue = np.meshgrid(centers, centers, indexing='ij')
+        green = green.reshape(-1, 1)
+        blue = blue.reshape(-1, 1)
+        grid = np.empty((size, size * size), dtype=np.int16)
+        # One red slice at a time to keep the distance matrix small
+        for i, red in enumerate(centers):
+            dists = np.sqrt((red - pal[:, 0])**2 + (green - pal[:, 1])**2 +
+                    (blue - pal[:, 2])**2)
+            rows = np.arange(dists.shape[0])
+            best = np.argmin(dists, axis=1)
+            best_dist = dists[rows, best]
+            dists[rows, best] = np.inf
+            second_dist = dists.min(axis=1)
+            grid[i] = np.where(second_dist - best_dist > 2 * radius,
+                    targets[best], -1)
+        return grid.reshape(size, size, size)
+
+    def search(self, colors):
+        """Exact palette indices for packed colors."""
+        return search_packed(colors, self.palette)
+
+    def resolve(self, colors):
+        """Palette indices for packed colors, searching only unseen ones."""
+        return self.resolved.lookup(colors)
+
+    def nearest(self, pixels):
+        """
+        Palette indices of the closest palette colors for a list of RGB pixel
+        arrays. Colors the grid can't answer are collected from all the
+        arrays and resolved at once.
+        """
+        lookups = []
+        for pixel_array in pixels:
+            indices = self.cells(pixel_array)
+            ambiguous = indices < 0
+            instrument.count('ambiguous_pixels', int(ambiguous.sum()))
+            lookups.append((indices, ambiguous,
+                    pack_array(pixel_array[ambiguous])))
+        colors = np.unique(np.concatenate([i[2] for i in lookups] +
+                [np.zeros(0, dtype=np.uint32)]))
+        if len(colors):
+            resolved = self.resolve(colors)
+        for indices, ambiguous, packed in lookups:
+            if len(packed):
+                indices[ambiguous] = resolved[np.searchsorted(colors, packed)]
+        return [i[0] for i in lookups]
+
+    def cells(self, pixel_array):
+        """Grid values of an RGB pixel array, -1 where a cell is ambiguous"""
+        return self.grid[pixel_array[..., 0] >> self.shift,
+                         pixel_array[..., 1] >> self.shift,
+                         pixel_array[..., 2] >> self.shift]
+
+    def apply(self, img):
+        """Convert an RGB image to a paletted image"""
+        return self.apply_all([img])[0]
+
+    @instrument.timed('tiq.lut')
+    def apply_all(self, imgs):
+        """Convert a list of RGB images to paletted images"""
+        pixels = [np.asarray(i, dtype=np.uint8) for i in imgs]
+        imgs_out = []
+        for pixel_array, indices in zip(pixels, self.nearest(pixels)):
+            keep_constant_colors(indices, pack_array(pixel_array),
+                    self.constant_keys, self.constant_values)
+            img_out = Image.fromarray(indices.astype(np.uint8), 'P')
+            img_out.putpalette(self.palette.raw)
+            imgs_out.append(img_out)
+        return imgs_out
+
+class ColorCache(object):
+    """
+    Growing mapping from packed colors to palette indices, stored as sorted
+    arrays to keep it compact. Colors not seen before are passed to the
+    search function, which returns their palette indices.
+
+    If a path is given, the cache is memory-mapped from that file and the
+    colors added to it are written back by save, once when the process
+    exits.
+    """
+
+    def __init__(self, search, path=None):
+        self.search = search
+        self.path = path
+        self.keys = np.zeros(0, dtype=np.uint32)
+        self.values = np.zeros(0, dtype=np.int16)
+        self.changed = False
+        if path:
+            self.load()
+
+    def load(self):
+        """Read the cache file, keys and values are its two rows"""
+        try:
+            data = np.load(self.path, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return
+        if data.ndim == 2 and data.shape[0] == 2:
+            self.keys = data[0]
+            self.values = data[1].astype(np.int16)
+
+    def save(self):
+        """
+        Write new colors to the cache file. Colors other processes have saved
+        meanwhile are merged in first. The merge holds a lock on the cache, so
+        that none of them get lost, except on systems without fcntl where the
+        last writer wins.
+        """
+        if not self.path or not self.changed:
+            return
+        try:
+            lock = open(self.path + '.lock', 'a')
+        except (IOError, OSError):
+            return
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            on_disk = ColorCache(None, self.path)
+            new = ~self.contains(on_disk.keys)
+            self.add(on_disk.keys[new], on_disk.values[new])
+            data = np.vstack((self.keys, self.values.astype(np.uint32)))
+            write_cache(self.path, lambda f: np.save(f, data))
+        finally:
+            # Closing the file releases the lock
+            lock.close()
+        self.changed = False
+
+    def add(self, keys, values):
+        """Add new colors and their palette indices"""
+        order = np.argsort(keys)
+        keys = np.asarray(keys, dtype=np.uint32)[order]
+        values = np.asarray(values, dtype=np.int16)[order]
+        # Merge into the sorted arrays instead of sorting everything again
+        positions = np.searchsorted(self.keys, keys)
+        self.keys = np.insert(self.keys, positions, keys)
+        self.values = np.insert(self.values, positions, values)
+
+    @instrument.timed('tiq.color_cache')
+    def lookup(self, colors):
+        """Palette indices for an array of unique packed colors"""
+        colors = np.asarray(colors, dtype=np.uint32)
+        new = colors[~self.contains(colors)]
+        instrument.count('hits', len(colors) - len(new))
+        instrument.count('misses', len(new))
+        if len(new):
+            self.add(new, self.search(new))
+            self.changed = True
+        return self.values[np.searchsorted(self.keys, colors)]
+
+    def contains(self, colors):
+        """Boolean array telling which colors are in the cache"""
+        if not len(self.keys):
+            return np.zeros(len(colors), dtype=bool)
+        # Binary search instead of in1d, which would sort the whole cache
+        positions = np.searchsorted(self.keys, colors)
+        positions = positions.clip(0, len(self.keys) - 1)
+        return self.keys[positions] == colors
+
+def cache_key(*args):
+    """Short hash of the data a lookup table or a color cache depends on"""
+    return hashlib.md5(repr(args).encode('ascii')).hexdigest()[:16]
+
+def get_color_cache(search, *args):
+    """
+    Persistent color cache for the results of a search function. The
+    arguments must identify everything the results depend on.
+    """
+    path = os.path.join(CACHE_PATH, 'ttd_color_cache_{0}.npy'.format(
+            cache_key(*args)))
+    if path not in _color_caches:
+        _color_caches[path] = ColorCache(search, path)
+    return _color_caches[path]
+
+def quantization_cache(palette, ignored_colors, method, metric):
+    """
+    Persistent color cache for quantizing to the palette, leaving the no
+    quant colors as they are.
+    """
+    no_quant_colors = get_no_quant_colors(palette, ignored_colors)
+    keys, values = constant_table(palette, no_quant_colors)
+    def search(colors):
+        indices = search_packed(colors, palette, method, metric)
+        keep_constant_colors(indices, colors, keys, values)
+        return indices
+    # The search methods only differ in how exact ties are broken, so they
+    # can share the results
+    return get_color_cache(search, 'quantize', palette.full, palette.neutral,
+            sorted(no_quant_colors), metric)
+
+def save_caches():
+    """Write the colors found during this run to the cache files"""
+    for cache in _color_caches.values():
+        cache.save()
+
+atexit.register(save_caches)
+
+def get_lut(palette, ignored_colors):
+    """Lookup table for this palette and set of ignored colors"""
+    ignored = tuple(sorted(flatten(ignored_colors or [])))
+    key = (palette.key, ignored)
+    if key not in _luts:
+        _luts[key] = PaletteLUT(palette, ignored)
+    return _luts[key]
+
+def pack(color):
+    """Pack an RGB tuple into a single integer"""
+    return color[0] << 16 | color[1] << 8 | color[2]
+
+def unpack(value):
+    """Unpack an integer into an RGB tuple"""
+    value = int(value)
+    return (value >> 16 & 255, value >> 8 & 255, value & 255)
+
+def unpack_array(values):
+    """Unpack an array of integers into an array of RGB values"""
+    values = np.asarray(values, dtype=np.uint32)
+    return np.column_stack((values >> 16 & 255, values >> 8 & 255,
+                            values & 255)).astype(np.uint8)
+
+def pack_array(pixels):
+    """Pack the RGB channels of a pixel array into uint32 values"""
+    pixels = pixels.astype(np.uint32)
+    return pixels[..., 0] << 16 | pixels[..., 1] << 8 | pixels[..., 2]
+
+def constant_table(palette, colors):
+    """
+    Sorted packed colors and their palette indices, for looking up colors
+    which are never quantized.
+    """
+    keys = np.array(sorted(set(pack(i) for i in colors)), dtype=np.uint32)
+    values = np.array([palette.index_of(unpack(i)) for i in keys],
+            dtype=np.int16)
+    return keys, values
+
+def keep_constant_colors(indices, packed, keys, values):
+    """Set the palette index of the pixels which are never quantized"""
+    constant = np.in1d(packed, keys).reshape(packed.shape)
+    indices[constant] = values[np.searchsorted(keys, packed[constant])]
+    return constant
+
 def flatten(list_):
     """Flatten lists of tuples into a list of tuples"""
     for i in list_:
@@ -131,46 +631,290 @@ def update_constant_colors(mapping, colors):
     mapping.update(cols)
     return mapping
 
-def main(img, palette, ignored_colors):
+def get_no_quant_colors(palette, ignored_colors):
+    """Colors which are kept as they are instead of being quantized"""
+    # flatten returns a generator, so convert it to list
+    ignored_colors = list(flatten(ignored_colors or []))
+    return list(palette.targets(ignored_colors).no_quant_colors)
+
+def bayer_matrix(size):
+    """Ordered dithering thresholds between -0.5 and 0.5"""
+    matrix = np.zeros((1, 1))
+    while len(matrix) < size:
+        matrix = np.vstack((np.hstack((4 * matrix, 4 * matrix + 2)),
+                            np.hstack((4 * matrix + 3, 4 * matrix + 1))))
+    return (matrix + 0.5) / matrix.size - 0.5
+
+def nearest_indices(pixels, palette, method=None, metric='rgb'):
+    """Palette indices of the closest neutral colors for an RGB pixel array"""
+    if method == 'lut':
+        return get_lut(palette, None).nearest([pixels])[0]
+    colors, inverse = np.unique(pack_array(pixels), return_inverse=True)
+    colors = [unpack(i) for i in colors]
+    mapping = indexify(quantize(colors, palette.neutral, method, metric),
+            palette)
+    values = np.array([mapping[i] for i in colors], dtype=np.int16)
+    return values[inverse].reshape(pixels.shape[:2])
+
+def dither_ordered(pixels, palette, method=None, metric='rgb'):
     """
-    The main method for quantization that combines all the required methods
+    Ordered dithering, offset every pixel by a threshold from a tiled Bayer
+    matrix before finding the closest palette color.
     """
-    img = convert(img, palette.bg)
-    colors = get_unique_colors(img)
-    try:
-        __import__('numpy')
-        __import__('scipy')
-    except ImportError:
-        mapping = quant_brute(colors, palette.neutral)
+    height, width = pixels.shape[:2]
+    matrix = bayer_matrix(BAYER_SIZE) * BAYER_SPREAD
+    reps = (height // BAYER_SIZE + 1, width // BAYER_SIZE + 1)
+    offsets = np.tile(matrix, reps)[:height, :width, np.newaxis]
+    shifted = (pixels + offsets).round().clip(0, 255).astype(np.uint8)
+    return nearest_indices(shifted, palette, method, metric)
+
+def dither_floyd_steinberg(pixels, skip, palette, metric='rgb'):
+    """
+    Floyd-Steinberg error diffusion. Pixels in the skip mask neither receive
+    nor spread error.
+
+    A pixel only depends on the pixel to its left and the three pixels above
+    it, so all the pixels on a line x + 2y = t can be processed at once. The
+    line is swept across the image instead of going pixel by pixel. Colors
+    are rounded and remembered once found. New ones are looked up in the
+    lookup table with the rgb metric, and searched in the k-d tree of the
+    palette if the table can't answer or for the other metrics.
+    """
+    height, width = skip.shape
+    colors = np.array(palette.full, dtype=np.float64)
+    targets = np.array(palette.neutral_indices, dtype=np.int16)
+    lut = get_lut(palette, None) if metric == 'rgb' else None
+    if default_method() == 'kdtree':
+        tree = palette_tree(palette.neutral, metric)
+        search = lambda x: targets[query_tree(tree, color_coords(x, metric),
+                len(targets))]
+    elif lut is not None:
+        search = lambda x: lut.search(pack_array(x))
     else:
-        mapping = quant_sp(colors, palette.neutral)
-    no_quant_colors = [palette.bg, palette.onecc, palette.act, palette.white]
-    # flatten returns a generator, so convert it to list
-    no_quant_colors = list(flatten(no_quant_colors))
-    if ignored_colors:
-        for i in flatten(ignored_colors):
-            no_quant_colors.remove(i)
+        raise ValueError('Metric {0} needs scipy'.format(metric))
+    def nearest(colors):
+        if lut is None:
+            return search(colors)
+        indices = lut.cells(colors)
+        ambiguous = indices < 0
+        if ambiguous.any():
+            indices[ambiguous] = search(colors[ambiguous])
+        return indices
+    # Palette index plus one of every packed color found so far. Only the
+    # pages where colors are stored are ever allocated.
+    seen = np.zeros(1 << 24, dtype=np.int16)
+    # Pad one row below and one column on both sides, so that error pushed
+    # over the edges needs no special handling. The padded pixels are stored
+    # line by line, so that the pixels of a line and the pixels each of the
+    # error weights pushes error to are slices of the arrays.
+    stride = width + 2
+    # First and last row of every line, and where the line starts
+    lines = np.arange(stride + 2 * height)
+    top = np.maximum(0, (lines - stride + 2) // 2)
+    bottom = np.minimum(height, lines // 2)
+    starts = np.concatenate(([0], np.cumsum(bottom - top + 1)[:-1]))
+    # Position of the pixel at y on line t is first[t] + y
+    first = starts - top
+    ys, xs = np.mgrid[:height + 1, :stride]
+    positions = (first[xs + 2 * ys] + ys).ravel()
+    first = first.tolist()
+    values = np.zeros((len(positions), 3))
+    padded = np.zeros((height + 1, stride, 3))
+    padded[:height, 1:width+1] = pixels
+    values[positions] = padded.reshape(-1, 3)
+    # Skipped pixels don't spread error, and what they receive is unused
+    spread = np.zeros((len(positions), 1))
+    padded = np.zeros((height + 1, stride, 1))
+    padded[:height, 1:width+1, 0] = ~skip
+    spread[positions] = padded.reshape(-1, 1)
+    weights = [(dx + 2 * dy, dy, weight) for dy, dx, weight in FS_WEIGHTS]
+    found = np.zeros(len(values), dtype=np.int16)
+    for t in range(1, width + 2 * height - 1):
+        top = max(0, (t - width + 1) // 2)
+        count = min(height - 1, (t - 1) // 2) + 1 - top
+        start = first[t] + top
+        here = slice(start, start + count)
+        current = values[here]
+        np.clip(current, 0, 255, out=current)
+        rounded = (current + 0.5).astype(np.uint8)
+        packed = pack_array(rounded)
+        best = seen[packed] - 1
+        new = best < 0
+        if new.any():
+            best[new] = nearest(rounded[new])
+            seen[packed[new]] = best[new] + 1
+        found[here] = best
+        error = (current - colors[best]) * spread[here]
+        for line, dy, weight in weights:
+            start = first[t + line] + top + dy
+            values[start:start + count] += error * weight
+    return found[positions].reshape(height + 1, stride)[:height, 1:width+1]
+
+@instrument.timed('tiq.dither')
+def dither(img, palette, ignored_colors, mode, method=None, metric='rgb'):
+    """Quantize an RGB image to the palette using a dithering mode"""
+    if np is None:
+        raise ImportError('Dithering requires numpy')
+    pixels = np.asarray(img, dtype=np.uint8)
+    packed = pack_array(pixels)
+    keys, values = constant_table(palette,
+            get_no_quant_colors(palette, ignored_colors))
+    constant = np.in1d(packed, keys).reshape(packed.shape)
+    if mode == 'ordered':
+        indices = dither_ordered(pixels, palette, method, metric)
+    elif mode == 'floyd-steinberg':
+        indices = dither_floyd_steinberg(pixels, constant, palette, metric)
+    else:
+        raise ValueError('Unknown dithering mode: {0}'.format(mode))
+    keep_constant_colors(indices, packed, keys, values)
+    img_out = Image.fromarray(indices.astype(np.uint8), 'P')
+    img_out.putpalette(palette.raw)
+    return img_out
+
+@instrument.timed('tiq.strips')
+def quantize_strips(img, palette, ignored_colors, method, metric,
+        strip_pixels=STRIP_PIXELS):
+    """
+    Quantize an image in horizontal strips of at most strip_pixels pixels,
+    so that memory use stays bounded no matter how large the image is.
+    Colors are searched only the first time they are seen in any strip.
+    """
+    if method == 'lut':
+        lut = get_lut(palette, ignored_colors)
+    else:
+        cache = quantization_cache(palette, ignored_colors, method, metric)
+    width, height = img.size
+    strip_height = max(1, strip_pixels // max(1, width))
+    img_out = Image.new('P', img.size)
+    img_out.putpalette(palette.raw)
+    for top in range(0, height, strip_height):
+        box = (0, top, width, min(height, top + strip_height))
+        strip = convert(img.crop(box), palette.bg)
+        instrument.count('strips')
+        if method == 'lut':
+            strip = lut.apply(strip)
+        else:
+            colors, inverse = np.unique(
+                    pack_array(np.asarray(strip, dtype=np.uint8)),
+                    return_inverse=True)
+            indices = cache.lookup(colors)[inverse]
+            strip = Image.fromarray(indices.astype(np.uint8).reshape(
+                    strip.size[1], strip.size[0]), 'P')
+        img_out.paste(strip, box[:2])
+    return img_out
+
+def get_mapping(colors, palette, ignored_colors, method=None, metric='rgb'):
+    """Mapping from colors to palette indices"""
+    mapping = quantize(colors, palette.neutral, method, metric)
+    no_quant_colors = get_no_quant_colors(palette, ignored_colors)
     mapping = update_constant_colors(mapping, no_quant_colors)
-    mapping = indexify(mapping, palette.full)
-    img = replace_colors(img, palette.raw, mapping)
-    return img
+    mapping = indexify(mapping, palette)
+    return mapping
 
-if __name__ == '__main__':
+def main(img, palette, ignored_colors, method=None, metric='rgb',
+        dither_mode=None):
+    """
+    The main method for quantization that combines all the required methods
 
-    # Tests
-    img = read_rgb('tester.png', 0)
-    out = read_rgb('dos_newgrf.png', 255)
-    out.save('outtest.png')
-    start_time = time.time()
-    uniq_cols = get_unique_colors(img)
-    now('unique colors')
-    start_time = time.time()
-    mapp = quantize(uniq_cols, dospal)
-    now('quantization with optim')
-    start_time = time.time()
-    mapp = indexify(mapp, dospal)
-    now('indexification')
-    start_time = time.time()
-    img = replace_colors(img, dospal, mapp)
-    now('colors replaced')
-    img.save('out.png')
+    method selects how the closest palette colors are searched, one of
+    METHODS. The default is the lookup table for the rgb metric when numpy is
+    available, otherwise the best remaining method.
+    metric selects the color distance, one of METRICS.
+    dither_mode is one of DITHER_MODES, by default no dithering is done.
+    """
+    return batch([img], palette, ignored_colors, method, metric,
+            dither_mode)[0]
+
+@instrument.timed('tiq.batch')
+def batch(imgs, palette, ignored_colors, method=None, metric='rgb',
+        dither_mode=None):
+    """
+    Quantize a set of images, for example all the frames of an item, with one
+    shared color mapping. The unique colors of all the images are quantized
+    together only once.
+
+    imgs is either a list of images or a dict of images, like the frames
+    dict of jbase.item.Item with rendered images as values. The converted
+    images are returned in the same form.
+
+    When the images have more than STREAM_PIXELS pixels in total, they are
+    quantized one strip at a time instead of all at once.
+    """
+    if metric not in METRICS:
+        raise ValueError('Unknown metric: {0}'.format(metric))
+    if method is None and np is not None and metric == 'rgb':
+        method = 'lut'
+    if isinstance(imgs, dict):
+        keys = list(imgs.keys())
+        imgs_out = batch([imgs[i] for i in keys], palette, ignored_colors,
+                method, metric, dither_mode)
+        return dict(zip(keys, imgs_out))
+    if method == 'lut' and metric != 'rgb':
+        raise ValueError('Method lut only supports the rgb metric')
+    dithering = dither_mode is not None and dither_mode != 'none'
+    streaming = (not dithering and np is not None and
+            sum(i.size[0] * i.size[1] for i in imgs) > STREAM_PIXELS)
+    if not streaming:
+        imgs = [convert(i, palette.bg) for i in imgs]
+    if dithering:
+        # Dithered colors depend on their neighbours, so there is no mapping
+        # to share between the images
+        imgs = [dither(i, palette, ignored_colors, dither_mode, method,
+                metric) for i in imgs]
+    elif streaming:
+        # The color caches are shared by the strips of all the images, so
+        # the result is the same as quantizing everything at once
+        imgs = [quantize_strips(i, palette, ignored_colors, method, metric)
+                for i in imgs]
+    elif method == 'lut':
+        # Straight table lookup, the table is built once per palette
+        imgs = get_lut(palette, ignored_colors).apply_all(imgs)
+    elif np is not None:
+        cache = quantization_cache(palette, ignored_colors, method, metric)
+        packed = [pack_array(np.asarray(i, dtype=np.uint8)) for i in imgs]
+        colors = np.unique(np.concatenate([i.ravel() for i in packed]))
+        instrument.count('unique_colors', len(colors))
+        values = cache.lookup(colors).astype(np.uint8)
+        imgs = []
+        for i in packed:
+            img = Image.fromarray(values[np.searchsorted(colors, i)], 'P')
+            img.putpalette(palette.raw)
+            imgs.append(img)
+    else:
+        colors = set()
+        for img in imgs:
+            colors.update(get_unique_colors(img))
+        mapping = get_mapping(list(colors), palette, ignored_colors, method,
+                metric)
+        imgs = [replace_colors(i, palette.raw, mapping) for i in imgs]
+    return imgs
+
+def prepare(palette, ignored_colors, method=None, metric='rgb'):
+    """
+    Load the lookup table or color cache batch uses for these options ahead
+    of time, for example before starting worker processes which share them.
+    """
+    palette.targets(ignored_colors)
+    if method is None and np is not None and metric == 'rgb':
+        method = 'lut'
+    if method == 'lut':
+        get_lut(palette, ignored_colors)
+    elif np is not None:
+        quantization_cache(palette, ignored_colors, method, metric)
+
+@instrument.timed('tiq.remap')
+def remap(img, src, dst):
+    """
+    Convert an 8bpp image from palette src to palette dst without quantizing
+    it again, see palette.remap_table.
+    """
+    if img.mode != 'P':
+        raise ValueError('Only 8bpp images can be remapped')
+    img_out = img.point(palette_module.remap_table(src, dst))
+    img_out.putpalette(dst.raw)
+    return img_out
+
+if __name__ == '__main__':
+    # Benchmark the quantization stages
+    import benchmark
+    sys.exit(benchmark.main(['--filter', 'tiq.'] + sys.argv[1:]))
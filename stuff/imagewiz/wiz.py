@@ -0,0 +1,317 @@
+"""
+The ImageWiz image operations. imagewiz.py is the command line for them.
+"""
+
+import hashlib
+import os
+from PIL import Image
+import shutil
+import StringIO
+import subprocess
+
+from atomicfile import write_cache
+import compositor
+import instrument
+from palette import find_palette, palettes
+import pngsave
+import rawimage
+import resampler
+import resultcache
+import tiq
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Flattened xcf files are cached here, keyed by the file contents and the
+# layers, unless another directory is set in the environment
+XCF_CACHE_PATH = os.environ.get('IMAGEWIZ_XCF_CACHE', os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'xcf_cache'))
+
+def open_image(name):
+    """Open a png or other image file, or map a raw image file"""
+    if rawimage.is_raw(name):
+        return rawimage.open_raw(name)
+    return Image.open(name)
+
+def xcf_cache_name(img, layers):
+    """Cache file name for the flattened layers of an xcf file"""
+    digest = hashlib.md5(resultcache.file_digest(img).encode('utf-8'))
+    # The layer order matters to xcf2png, so it is kept in the key
+    digest.update(repr(tuple(layers or ())).encode('utf-8'))
+    return os.path.join(XCF_CACHE_PATH,
+            'xcf_{0}.png'.format(digest.hexdigest()))
+
+class ImageWiz(object):
+    """
+    Alpha reduction is not done right away. The thresholded alpha is kept
+    aside, autocrop takes the bounding box from it, and 8bpp conversion pastes
+    the image over the background color with it in one go. The image itself
+    is only changed when something else needs it.
+    """
+
+    @instrument.timed('imagewiz.open')
+    def __init__(self, img, layers=None):
+        if '.xcf' in img:
+            img = self._xcf_to_png(img, layers)
+        self.img = open_image(img)
+
+    @property
+    def img(self):
+        """The image, with pending operations applied"""
+        if self._alpha is not None:
+            self._apply_alpha()
+        return self._img
+
+    @img.setter
+    def img(self, img):
+        self._img = img
+        # Thresholded alpha which hasn't been applied to the image yet
+        self._alpha = None
+
+    @property
+    def size(self):
+        """Size of the image, without applying pending operations"""
+        return self._img.size
+
+    @instrument.timed('imagewiz.apply_alpha')
+    def _apply_alpha(self):
+        """Apply a pending alpha reduction to the image"""
+        alpha = self._alpha
+        self._alpha = None
+        self._img.putalpha(alpha)
+        # Transparent pixels still have color data. Change them to black.
+        img = Image.new('RGBA', self._img.size, (0, 0, 0, 0))
+        img.paste(self._img, mask=alpha)
+        self._img = img
+
+    @instrument.timed('imagewiz.xcf_to_png')
+    def _xcf_to_png(self, img, layers):
+        """
+        Convert xcf file to png with xcf2png. The result is cached, so that
+        the same layers of an unchanged file are converted only once.
+        """
+        cached = xcf_cache_name(img, layers)
+        if os.path.exists(cached):
+            instrument.count('hits')
+            return cached
+        instrument.count('misses')
+        args = ['xcf2png', '--autocrop', '{0}'.format(img)]
+        if layers:
+            args.extend(layers)
+        print args
+        proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+        data = proc.communicate()[0]
+        if proc.returncode or not data:
+            raise IOError('xcf2png failed for {0}'.format(img))
+        write_cache(cached, lambda f: f.write(data))
+        return StringIO.StringIO(data)
+
+    @instrument.timed('imagewiz.autocrop')
+    def autocrop(self):
+        """Autocrop transparency from image, return offsets."""
+        # Everything outside the reduced alpha will be black and transparent,
+        # so the bbox can be taken from it without applying it first
+        if self._alpha is not None:
+            bbox = self._alpha.getbbox()
+        else:
+            bbox = self._img.getbbox()
+        self._crop(bbox)
+        # Only the coordinates from top left corner are needed for ttd offset
+        # purposes
+        return bbox[0:2]
+
+    def _crop(self, bbox):
+        """Crop the image and a pending alpha reduction"""
+        if self._alpha is not None:
+            self._alpha = self._alpha.crop(bbox)
+        self._img = self._img.crop(bbox)
+
+    def _nonzero(self):
+        """Array which is true for the pixels autocrop keeps"""
+        if self._alpha is not None:
+            return np.asarray(self._alpha) != 0
+        pixels = np.asarray(self._img)
+        if pixels.ndim == 3:
+            return pixels.any(axis=2)
+        return pixels != 0
+
+    @instrument.timed('imagewiz.composite')
+    def composite(self, img2, mode='over'):
+        """
+        Various alpha compositing methods.
+
+        Over: paste img2 over the current image.
+        In: multiply the alpha values of the current image and img2, set this
+        alpha for the current image.
+        Out: like in, with the alpha of img2 inverted.
+        Multiply: multiply the colors where both are opaque, paste img2 over
+        the current image elsewhere. Needs numpy.
+
+        img2 is a file name or an already opened image.
+        """
+        self.composite_layers([(img2, mode)])
+
+    @instrument.timed('imagewiz.composite_layers')
+    def composite_layers(self, layers):
+        """
+        Apply a list of (image, mode) layers in order, with the modes of
+        composite. The images are file names or already opened images.
+        """
+        layers = [(i if isinstance(i, Image.Image) else open_image(i), mode)
+                  for i, mode in layers]
+        self.img = compositor.composite(self.img, layers)
+
+    @instrument.timed('imagewiz.resize')
+    def resize(self, size, mode='aa'):
+        """
+        Resize image. Reductions by a whole factor with the aa filter are
+        averages of blocks of pixels, see resampler.
+        """
+        # Resize method returns a copy
+        self.img = resampler.resize(self.img, size, mode)
+
+
+    @instrument.timed('imagewiz.reduce_alpha')
+    def reduce_alpha(self, value):
+        """
+        For every pixel with an alpha value higher than or equal to the
+        parameter value, increase alpha to 255. For every other pixel reduce
+        alpha to 0.
+        """
+        if self._img.mode == 'RGBA':
+            value = int(value)
+            # A second reduction works on the blackened image of the first
+            if self._alpha is not None:
+                self._apply_alpha()
+            # Get alpha band
+            alpha = self._img.split()[3]
+            self._alpha = alpha.point(lambda x: x >= value and 255)
+        else:
+            print "Image mode was not RGBA, no alpha reduced."
+
+    @instrument.timed('imagewiz.to_8bpp')
+    def to_8bpp(self, palette, ignored_colors=None, method=None,
+            metric='rgb', dither=None):
+        """Convert to 8bpp ttd paletted image"""
+        img = self._img
+        if self._alpha is not None:
+            # Same as what tiq does with transparent pixels, without applying
+            # the reduced alpha to the image first
+            img = Image.new('RGB', self._img.size, palette.bg)
+            img.paste(self._img.convert('RGB'), mask=self._alpha)
+        self.img = tiq.main(img, palette, ignored_colors, method, metric,
+                dither)
+
+    @instrument.timed('imagewiz.remap_8bpp')
+    def remap_8bpp(self, palette, src=None):
+        """
+        Move an 8bpp image to another ttd palette without requantizing.
+        src is the current palette, found from the image if not given.
+        """
+        if src is None:
+            name = find_palette(self.img.getpalette() or [])
+            if name is None:
+                raise ValueError('Image palette is not a known palette')
+            src = palettes[name]
+        self.img = tiq.remap(self.img, src, palette)
+
+    @instrument.timed('imagewiz.save')
+    def save(self, name, profile='default'):
+        """
+        Save image as png, profile is one of pngsave.PROFILES. Names ending in
+        rawimage.RAW_EXTENSION are saved as uncompressed raw images.
+        """
+        if rawimage.is_raw(name):
+            rawimage.save(self.img, name)
+        else:
+            pngsave.save(self.img, name, profile)
+
+def to_8bpp_batch(imgs, palette, ignored_colors=None, method=None,
+        metric='rgb', dither=None):
+    """
+    Convert a list or dict of ImageWiz objects to 8bpp with one color mapping
+    shared by all of them.
+    """
+    if isinstance(imgs, dict):
+        imgs = list(imgs.values())
+    converted = tiq.batch([i.img for i in imgs], palette, ignored_colors,
+            method, metric, dither)
+    for img, img_8bpp in zip(imgs, converted):
+        img.img = img_8bpp
+
+@instrument.timed('imagewiz.autocrop_batch')
+def autocrop_batch(imgs):
+    """
+    Autocrop a list of ImageWiz objects, return the offsets of every one.
+    The bounding boxes of all the images of the same size are found at once.
+    Images with nothing to keep are left as they are, with offsets (0, 0).
+    """
+    if np is None:
+        bboxes = [i._alpha.getbbox() if i._alpha is not None else
+                  i._img.getbbox() for i in imgs]
+    else:
+        bboxes = [None] * len(imgs)
+        groups = {}
+        for i, img in enumerate(imgs):
+            groups.setdefault(img.size, []).append(i)
+        for (width, height), group in groups.items():
+            nonzero = np.array([imgs[i]._nonzero() for i in group])
+            rows = nonzero.any(axis=2)
+            cols = nonzero.any(axis=1)
+            top = rows.argmax(axis=1)
+            bottom = height - rows[:, ::-1].argmax(axis=1)
+            left = cols.argmax(axis=1)
+            right = width - cols[:, ::-1].argmax(axis=1)
+            for j, i in enumerate(group):
+                if rows[j].any():
+                    bboxes[i] = (int(left[j]), int(top[j]), int(right[j]),
+                                 int(bottom[j]))
+    offsets = []
+    for img, bbox in zip(imgs, bboxes):
+        if bbox is None:
+            offsets.append((0, 0))
+        else:
+            img._crop(bbox)
+            offsets.append(bbox[0:2])
+    return offsets
+
+@instrument.timed('imagewiz.derive_zooms')
+def derive_zooms(infile, outbase, palette='dos', flags=(),
+        profile='default'):
+    """
+    Write the 4x, 2x, 1x and 8bpp versions of a 4x zoom image, decoding it
+    only once. Each zoom level is half of the previous one, and the 8bpp
+    image is the 1x one converted to palette with the palette-8bpp flags.
+    Return the names of the written files, keyed by zoom.
+    """
+    names = dict((i, '{0}_{1}.png'.format(outbase, i))
+                 for i in ('4x', '2x', '1x', '8bpp'))
+    img = ImageWiz(infile)
+    if os.path.abspath(infile) != os.path.abspath(names['4x']):
+        shutil.copyfile(infile, names['4x'])
+    img.resize('0.5')
+    img.save(names['2x'], profile)
+    img.resize('0.5')
+    img.save(names['1x'], profile)
+    pal = palettes[palette]
+    ignored_colors, dither = parse_palette_flags(pal, flags)
+    img.to_8bpp(pal, ignored_colors, dither=dither)
+    img.save(names['8bpp'], profile)
+    return names
+
+def parse_palette_flags(palette, flags):
+    """
+    Split the flags of the palette-8bpp option into ignored colors and
+    dithering mode.
+    """
+    dither_flags = {'fs': 'floyd-steinberg', 'ordered': 'ordered'}
+    dither = None
+    palette_flags = []
+    for i in flags:
+        if i in dither_flags:
+            dither = dither_flags[i]
+        else:
+            palette_flags.append(i)
+    return palette.ignored_colors(palette_flags), dither
@@ -48,6 +48,20 @@ class Item(object):
                 depname = os.path.join(buildpath, depname)
                 blender_deps = open(depname, 'r').read()
 
+                # One pattern rule with several targets is run only once for
+                # all of them, so every frame is decoded only once. imagewiz
+                # derives all the zoom levels of a rendered frame in one go.
+                f.write((
+                        '{0}_{1}.png {0}_{2}.png {0}_{3}.png {0}_{4}.png: '
+                        '{0}_{5}.png\n'
+                        '\t$(_V) python $(IMAGEWIZ) zooms $< {6}\n\n'
+                        ).format(os.path.join(buildpath, '%'),
+                                 suff['zoom_4x'],
+                                 suff['zoom_2x'],
+                                 suff['zoom_1x'],
+                                 suff['olden'],
+                                 suff['rendered'],
+                                 os.path.join(buildpath, '$*')))
 
                 for i in self.frames:
                     rendername = os.path.join(buildpath, str(i))
@@ -61,34 +75,6 @@ class Item(object):
                                            suff['zoom_2x'],
                                            suff['zoom_1x'],
                                            suff['olden']))
-                    # 4x zoom
-                    f.write((
-                            '{0}_{1}.png: {0}_{2}.png\n'
-                            '\t$(_V) cp {0}_{2}.png {0}_{1}.png\n'
-                            ).format(rendername,
-                                     suff['zoom_4x'],
-                                     suff['rendered']))
-                    # 2x zoom
-                    f.write((
-                            '{0}_{1}.png: {0}_{2}.png\n'
-                            '\t$(_V) convert {0}_{2}.png -resize 50% '
-                            '{0}_{1}.png\n').format(rendername,
-                                                    suff['zoom_2x'],
-                                                    suff['rendered']))
-                    # 1x zoom
-                    f.write((
-                            '{0}_{1}.png: {0}_{2}.png\n'
-                            '\t$(_V) convert {0}_{2}.png -resize 25% '
-                            '{0}_{1}.png\n').format(rendername,
-                                                    suff['zoom_1x'],
-                                                    suff['rendered']))
-                    # 8bpp
-                    f.write((
-                            '{0}_{1}.png: {0}_{2}.png\n'
-                            '\t$(_V) convert {0}_{2}.png -resize 25% '
-                            '{0}_{1}.png\n').format(rendername,
-                                                    suff['olden'],
-                                                    suff['rendered']))
                     # Source png which we will modify
                     f.write((
                             '{0}_{1}.png: {2} {3}\n'
@@ -1,8 +1,14 @@
 #!/bin/bash
 
+import os
 from PIL import Image
 import sys
 
+# The corner images are loaded by the same code as in imagewiz
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'imagewiz'))
+from corners import load_corners
+
 buildpath = 'build/temp_gfx'
 
 def create_masks(imgs, suffix, bg=None):
@@ -40,24 +46,15 @@ def create_masks(imgs, suffix, bg=None):
            (2, 0, 0, 2, "0018")
           )
 
-    # Convert the array to a list we are going to modify
-    sprite_array = []
-    for i in spr:
-        sprite_array.append(list(i))
-    # Replace these numbers with the actual images from imgs-param
-    for i, sprite in enumerate(sprite_array):
-        for j, pos in enumerate(sprite):
-            if pos == 0:
-                sprite_array[i][j] = Image.open(imgs[0])
-            elif pos == 1:
-                sprite_array[i][j] = Image.open(imgs[1])
-            elif pos == 2:
-                sprite_array[i][j] = Image.open(imgs[2])
-            else:
-                continue
+    corners = load_corners(imgs)
 
     # Loop through the sprite list, creating masks for each tile
-    for i, sprite in enumerate(sprite_array):
+    for tile in spr:
+        # Replace the numbers with the corner images, already turned the
+        # right way for their position
+        sprite = [corners[pos][j] for j, pos in enumerate(tile[:4])]
+        sprite.extend(tile[4:])
+
         # Width is always the width of any corner sprite * 2, since in OpenTTD
         # all tiles are the same width
         width = 2 * sprite[0].size[0]
@@ -70,11 +67,8 @@ def create_masks(imgs, suffix, bg=None):
         bbox = Image.new('RGBA', (width, height))
         # Paste the corners
         bbox.paste(sprite[0], (0, 0))
-        sprite[1] = sprite[1].transpose(Image.FLIP_TOP_BOTTOM)
         bbox.paste(sprite[1], (0, sprite[0].size[1]-1))
-        sprite[2] = sprite[2].transpose(Image.FLIP_LEFT_RIGHT)
         bbox.paste(sprite[2], (width/2, 0))
-        sprite[3] = sprite[3].transpose(Image.ROTATE_180)
         bbox.paste(sprite[3], (width/2, sprite[2].size[1]-1))
        
         # Output canvas will be square, so width = height 
@@ -90,8 +84,8 @@ def create_masks(imgs, suffix, bg=None):
         # for 3d centering purposes
         if len(sprite) == 6:
             max_height = 0
-            for spr in sprite[0:4]:
-                h = spr.size[1]
+            for corner in sprite[0:4]:
+                h = corner.size[1]
                 if h > max_height:
                     max_height = h
                 else: